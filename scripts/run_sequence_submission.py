@@ -3,45 +3,87 @@
 import argparse
 import csv
 import codecs
+from collections import OrderedDict
 from datetime import datetime
+import difflib
 import glob
+import hashlib
 import json
+import mmap
+import multiprocessing
 import os
 import re
+import resource
 import shutil
+import signal
 import subprocess
+import struct
 import sys
+import tempfile
+import threading
+import time
+import unicodedata
 import xml.dom.minidom as minidom
 import xml.etree.cElementTree as ET
 import zipfile
+from multiprocessing.connection import Client, Listener
+from multiprocessing.pool import ThreadPool
+
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+try:
+  from cStringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+try:
+  from httplib import HTTPConnection, HTTPSConnection, HTTPException
+  from urllib import quote
+  from urlparse import urlparse
+except ImportError:
+  from http.client import HTTPConnection, HTTPSConnection, HTTPException
+  from urllib.parse import quote, urlparse
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
 
 #
 #Determine paths.
 #
 top = os.getenv("KB_TOP")
 
-template_deployed = os.path.join(top, "lib", "templates", "template.sbt")
-template_dev = os.path.join(top, "modules", "bvbrc_sequence_submission", "lib", "templates", "template.sbt")
-template_local = os.path.join("/home", "ac.mkuscuog", "git", "bvbrc_sequence_submission", "lib", "templates", "template.sbt")
-if os.path.exists(template_deployed):
-  SBT_TEMPLATE = template_deployed
-elif os.path.exists(template_dev):
-  SBT_TEMPLATE = template_dev
-else:
-  SBT_TEMPLATE = template_local
-print("SBT TEMPLATE:\n %s" %(SBT_TEMPLATE));
-
-elvira_deployed = os.path.join(top, "lib", "Elvira", "bin", "fluValidator2")
-elvira_dev = os.path.join(top, "modules", "bvbrc_sequence_submission", "lib", "Elvira", "bin", "fluValidator2")
-elvira_local = os.path.join("/home", "ac.mkuscuog", "git", "bvbrc_sequence_submission", "lib", "Elvira", "bin", "fluValidator2")
-if os.path.exists(elvira_deployed):
-  FLUVALIDATOR = elvira_deployed
-elif os.path.exists(elvira_dev):
-  FLUVALIDATOR = elvira_dev
-else:
-  FLUVALIDATOR = elvira_local
+def findResource(*relative_path):
+  #Resources are looked up in the deployed runtime, a development container and a local clone, in that order
+  candidates = []
+  if top:
+    candidates.append(os.path.join(top, *relative_path))
+    candidates.append(os.path.join(top, "modules", "bvbrc_sequence_submission", *relative_path))
+  candidates.append(os.path.join("/home", "ac.mkuscuog", "git", "bvbrc_sequence_submission", *relative_path))
+  for candidate in candidates:
+    if os.path.exists(candidate):
+      return candidate
+  return candidates[-1]
+
+#Resolved once per process, a daemon keeps them for all of its jobs
+SBT_TEMPLATE = findResource("lib", "templates", "template.sbt")
+FLUVALIDATOR = findResource("lib", "Elvira", "bin", "fluValidator2")
+
+ELVIRA_DIR = os.path.dirname(os.path.dirname(FLUVALIDATOR))
+ELVIRA_RESOURCES = os.path.join(ELVIRA_DIR, "resources")
 
 VIGOR_REF_DB = os.path.join("/opt", "patric-common", "runtime", "vigor-4.1.20220621-163707-2385247", "VIGOR_DB", "Reference_DBs")
+REFERENCE_DB_MANIFEST_FILE_NAME = ".staged_reference_dbs.json"
 
 DATABASE_MAP = {"influenza a virus": "flua", "influenza b virus": "flub", "influenza c virus": "fluc"}
 SEQUENCE_VALIDATION_FOLDER_NAME = "SequenceValidation"
@@ -50,17 +92,344 @@ SUBMISSION_FOLDER_NAME = "Submission"
 MANUAL_SUBMISSION_FOLDER_NAME = "ManualSubmission"
 METADATA_FILE_NAME = "metadata.csv"
 SUBMISSION_REPORT_FILE_NAME = "Sequence_Validation_Report.csv"
-SUBMISSION_FILE_HEADER = ["Unique_Sequence_Identifier", "Segment", "Serotype", "Status", "Messages"]
+INPUT_VALIDATION_REPORT_FILE_NAME = "Input_Validation_Report.csv"
+#Hidden so that manifests are not uploaded with the job results
+SAMPLE_MANIFEST_FOLDER_NAME = ".sample_manifests"
+UPLOAD_LEDGER_FILE_NAME = ".upload_ledger.json"
+SHARD_MANIFEST_FILE_NAME = "Shard_Manifest.json"
+SBT_FOLDER_NAME = ".sbt_templates"
+TBL2ASN_FOLDER_NAME = ".tbl2asn_batches"
+#Job files of the daemon move from the spool folder to these subfolders
+DAEMON_FOLDER_NAMES = ("running", "done", "failed", "logs")
+#Fields that change the rendered SBT, rendered SBT files are cached per process by their values
+SBT_JOB_FIELDS = ["first_name", "last_name", "email", "affiliation", "consortium", "street", "city", "state", "postal_code", "country"]
+SBT_METADATA_FIELDS = ["Publication Title", "Publication PMID", "Authors", "BioProject Accession", "BioSample Accession"]
+SBT_CACHE_SIZE = 1024
+SBT_CACHE = {}
+SBT_TEMPLATE_PARTS = []
+#Workspace types of uploaded files by suffix
+UPLOAD_SUFFIX_MAP = OrderedDict([("csv", "csv"), ("fasta", "contigs"), ("fsa", "contigs"), ("json", "json"), ("src", "csv"), ("xml", "xml")])
+INPUT_VALIDATION_FILE_HEADER = ["Level", "Sample_Identifier", "Unique_Sequence_Identifier", "Message"]
+COLLECTION_DATE_PATTERN = re.compile(r"^(\d{2}-[A-Za-z]{3}-\d{4}|[A-Za-z]{3}-\d{4}|\d{4}|U)$")
+METADATA_REQUIRED_COLUMNS = ["Sample Identifier", "Strain Name", "Organism", "Collection Date", "Collection Country", "Host", "Isolation Source", "Subtype"]
+SUBMISSION_FILE_HEADER = ["Unique_Sequence_Identifier", "Segment", "Serotype", "Status", "Messages",
+                          "Length", "Expected_Length", "N_Fraction", "Ambiguous_Fraction", "Invalid_Characters", "Internal_Stops", "QC_Flags"]
+VIGOR4_OUTPUT_EXTENSIONS = ("tbl", "cds", "gff3")
+ANNOTATION_CACHE_SEQUENCE_ID = "CACHED_SEQUENCE"
 SEGMENT_MAP = {"1": "PB2", "2": "PB1", "3": "PA", "4": "HA", "5": "NP", "6": "NA", "7": "MP", "8": "NS"}
+#Expected segment lengths per VIGOR4 database, from complete coding regions to full length segments
+SEGMENT_LENGTH_RANGES = {"flua": {"1": (2200, 2400), "2": (2200, 2400), "3": (2100, 2300), "4": (1650, 1800),
+                                  "5": (1450, 1600), "6": (1350, 1500), "7": (950, 1050), "8": (800, 900)},
+                         "flub": {"1": (2250, 2420), "2": (2250, 2420), "3": (2150, 2330), "4": (1700, 1900),
+                                  "5": (1650, 1850), "6": (1400, 1570), "7": (1050, 1200), "8": (950, 1100)},
+                         "fluc": {"1": (2250, 2380), "2": (2250, 2380), "3": (2100, 2200), "4": (1950, 2080),
+                                  "5": (1650, 1820), "6": (1050, 1190), "7": (850, 940)}}
+STOP_CODONS = ("TAA", "TAG", "TGA")
+#Reference sequences of the k-mer segment classifier, relative to the Elvira resources folder
+#Subtype labels of the references are serotypes for Flu A and lineages for Flu B
+KMER_REFERENCES = [{"format": "fasta", "path": os.path.join("h1n1SeasVsPdm", "all_consensi.fasta"), "database": "flua", "subtype": "serotype"},
+                   {"format": "blastdb", "path": os.path.join("fluB", "lineage", "HA_full_length_NT_complete.fa"), "database": "flub", "segment": "HA", "subtype": "lineage",
+                    "lineage_map": os.path.join("fluB", "lineage", "HA_gi_to_lineage_map.txt")}]
+KMER_SIZE = 12
+KMER_MIN_VOTES = 10
+#References only cover some subtypes, a subtype is assigned when this fraction of the sequence k-mers matches it
+#and it leads the next subtype by the margin fraction of the sequence k-mers
+KMER_MIN_SUBTYPE_FRACTION = 0.1
+KMER_MIN_SUBTYPE_MARGIN = 0.05
+KMER_INDEXES = {}
+#Country and host vocabularies of metadata normalization, relative to the Elvira folder
+NORMALIZATION_TABLES = OrderedDict([("insdc_countries", os.path.join("perllib", "TIGR", "INSDC_Countries.list")),
+                                    ("country_codes", os.path.join("perllib", "TIGR", "Mapped_Coutry_Codes.table")),
+                                    ("insdc_iso_codes", os.path.join("resources", "geonames", "insdc-iso-country-codes-map.csv")),
+                                    ("iso_country_names", os.path.join("resources", "geonames", "wikipedia-iso-country-codes.csv")),
+                                    ("edited_iso_country_names", os.path.join("resources", "geonames", "edited-wikipedia-iso-country-codes.csv")),
+                                    ("hosts", os.path.join("bin", "Normalized_Host.map"))])
+#Common and current INSDC country names missing from the Elvira tables, mapped to the name they normalize to
+COUNTRY_ALIASES = OrderedDict([("UK", "United Kingdom"), ("Great Britain", "United Kingdom"), ("Vietnam", "Viet Nam"),
+                               ("United States", "USA"), ("United States of America", "USA"), ("The Netherlands", "Netherlands"),
+                               ("Czechia", "Czechia"), ("Eswatini", "Eswatini"), ("North Macedonia", "North Macedonia"),
+                               ("Turkiye", "Turkiye"), ("Cabo Verde", "Cabo Verde"), ("Timor-Leste", "Timor-Leste")])
+#INSDC missing value vocabulary, accepted in place of a country with an optional reason after a colon
+COUNTRY_MISSING_VALUES = ["missing", "not applicable", "not collected", "not provided", "restricted access"]
+NORMALIZATION_INDEXES = {}
+NORMALIZATION_MAX_SUGGESTIONS = 3
+NAME_SEPARATOR_PATTERN = re.compile(r"[\W_]+", re.UNICODE)
+QC_VALID, QC_N, QC_AMBIGUOUS, QC_INVALID = range(4)
+QC_INVALID_PATTERN = re.compile("[^ACGTNRYSWKMBDHVacgtnryswkmbdhv]")
+QC_MAX_AMBIGUOUS_FRACTION = 0.1
+QC_MAX_REPORTED_POSITIONS = 10
 SRC_FILE_HEADER = ["Sequence_ID", "Organism", "Strain", "Country", "Host", "Collection-date", "Isolation-source", "Serotype"]
+PROFILE_JSON_FILE_NAME = "Sequence_Submission_Profile.json"
+PROFILE_CSV_FILE_NAME = "Sequence_Submission_Profile.csv"
+PROGRESS_FILE_NAME = "Sequence_Submission_Progress.jsonl"
+STATUS_FILE_NAME = "Sequence_Submission_Status.json"
+REPORT_PARQUET_FILE_NAME = "Sequence_Validation_Report.parquet"
+#Typed columns of the Parquet report, other columns are strings
+REPORT_NUMERIC_COLUMNS = {"Length": int, "Internal_Stops": int, "N_Fraction": float, "Ambiguous_Fraction": float}
+PROFILE_FILE_HEADER = ["Sample_Identifier", "Stage", "Command", "Wall_Time", "CPU_Time", "Peak_RSS_MB", "Return_Code"]
+PROFILE_RECORDS = []
+#External tools are scheduled with per tool concurrency limits shared by all processes, timeouts in seconds and retries
+TOOL_LIMITS = {"p3-cp": 4}
+TOOL_TIMEOUTS = {"p3-cp": 1800, "p3-mkdir": 300, "vigor4": 7200, "tbl2asn": 1800, "fluValidator2": 3600}
+TOOL_RETRIES = {"p3-cp": 3}
+TOOL_SEMAPHORES = {}
+#Tools are started in a new session, preexec_fn is the only way to do it before Python 3.2
+TOOL_SESSION_OPTIONS = {"start_new_session": True} if sys.version_info >= (3, 2) else {"preexec_fn": os.setsid}
+#Log file of the sample processed by the current thread
+TOOL_LOG = threading.local()
+#Persistent data API connections of the current thread, requests are retried with exponential backoff
+DATA_API_CONNECTIONS = threading.local()
+DATA_API_RETRIES = 3
+DATA_API_TIMEOUT = 300
+DATA_API_LIMIT = 25000
+DAEMON_STATE = {"stopping": False}
+#The umask can only be read by setting it, this is done once before any worker thread starts
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+def getPeakRSS():
+  #ru_maxrss is in kilobytes on Linux, the high water mark of this process or any of its waited children
+  return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+def addProfileRecord(sample_identifier, stage, command, wall_time, cpu_time, peak_rss, return_code=""):
+  PROFILE_RECORDS.append({"Sample_Identifier": sample_identifier,
+                          "Stage": stage,
+                          "Command": command,
+                          "Wall_Time": round(wall_time, 3),
+                          "CPU_Time": round(cpu_time, 3),
+                          "Peak_RSS_MB": round(peak_rss, 1),
+                          "Return_Code": return_code})
+
+def startProfileStage():
+  return (time.time(), os.times())
+
+def endProfileStage(start, stage, sample_identifier=""):
+  #CPU time includes the children waited for during the stage
+  start_time, start_times = start
+  end_times = os.times()
+  cpu_time = sum(end_times[:4]) - sum(start_times[:4])
+  addProfileRecord(sample_identifier, stage, "", time.time() - start_time, cpu_time, getPeakRSS())
+
+def collectProfileRecords(start_index, sample_identifier=""):
+  #Remove records added since start_index so that worker processes can return them to the parent
+  records = PROFILE_RECORDS[start_index:]
+  del PROFILE_RECORDS[start_index:]
+  for record in records:
+    record["Sample_Identifier"] = record["Sample_Identifier"] or sample_identifier
+  return records
+
+def parseToolSetting(value):
+  #Parse TOOL=N command line settings
+  tool, separator, number = value.partition("=")
+  try:
+    if not tool or not separator or int(number) < 0:
+      raise ValueError()
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected TOOL=N, got %s" %(value))
+  return tool, int(number)
+
+def initToolScheduler(semaphores, timeouts):
+  #Called in the main process and every worker so that all processes share the same tool limits
+  TOOL_SEMAPHORES.clear()
+  TOOL_SEMAPHORES.update(semaphores)
+  TOOL_TIMEOUTS.update(timeouts)
+
+def setToolLog(log_file):
+  TOOL_LOG.file = log_file
+
+def killProcessGroup(process):
+  #Tools run in their own process group so that the processes started by wrapper scripts are killed with them
+  try:
+    os.killpg(process.pid, signal.SIGKILL)
+  except OSError:
+    pass
+
+def killTimedOutProcess(process, timed_out):
+  timed_out.append(True)
+  killProcessGroup(process)
+
+def runToolCommand(cmd, stage, cwd, check, capture):
+  tool = os.path.basename(cmd[0])
+  semaphore = TOOL_SEMAPHORES.get(tool)
+  if semaphore is not None:
+    semaphore.acquire()
 
-def createFASTAFile(output_dir, job_data):
+  log_file = None
+  try:
+    #Tool output goes to the log file of the sample when there is one
+    if getattr(TOOL_LOG, "file", None):
+      log_file = open(TOOL_LOG.file, "a")
+      log_file.write("$ %s\n" %(" ".join(cmd)))
+      log_file.flush()
+
+    start_time = time.time()
+    process = subprocess.Popen(cmd, shell=False, cwd=cwd, stdout=subprocess.PIPE if capture else log_file, stderr=log_file, **TOOL_SESSION_OPTIONS)
+
+    timed_out = []
+    timer = None
+    try:
+      if TOOL_TIMEOUTS.get(tool):
+        timer = threading.Timer(TOOL_TIMEOUTS[tool], killTimedOutProcess, (process, timed_out))
+        timer.daemon = True
+        timer.start()
+
+      #Killing the process group on timeout closes the output pipe held by children of wrapper scripts, which ends the read.
+      #The process is reaped with wait4 instead of communicate to keep its resource usage.
+      output = process.stdout.read() if capture else None
+      pid, status, usage = os.wait4(process.pid, 0)
+    finally:
+      #Wait for the cancelled timer so that no timer thread is left at interpreter shutdown
+      if timer is not None:
+        timer.cancel()
+        timer.join()
+      killProcessGroup(process)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if capture:
+      process.stdout.close()
+  finally:
+    if log_file is not None:
+      log_file.close()
+    if semaphore is not None:
+      semaphore.release()
+
+  addProfileRecord("", stage, " ".join(cmd), time.time() - start_time, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0, process.returncode)
+
+  if timed_out:
+    raise RuntimeError("%s timed out after %d seconds" %(" ".join(cmd), TOOL_TIMEOUTS[tool]))
+
+  if check and process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, cmd, output)
+
+  return output if capture else process.returncode
+
+def runExternalCommand(cmd, stage, cwd=None, check=True, capture=False):
+  #Run an external tool within its concurrency limit and timeout, and record its own wall time, CPU time and peak RSS.
+  #Raises CalledProcessError like check_call and check_output when check is set, transient failures are retried.
+  retries = TOOL_RETRIES.get(os.path.basename(cmd[0]), 0) if check else 0
+  for attempt in range(retries + 1):
+    try:
+      return runToolCommand(cmd, stage, cwd, check, capture)
+    except (subprocess.CalledProcessError, RuntimeError) as e:
+      if attempt == retries:
+        raise
+      print("Retrying %s in %d seconds:\n %s" %(os.path.basename(cmd[0]), 2 ** attempt, e))
+      time.sleep(2 ** attempt)
+
+def writeProfile(output_dir, records, summary):
+  #Aggregate records per stage, commands are aggregated under their stage and tool name
+  stages = OrderedDict()
+  for record in records:
+    name = record["Stage"] if not record["Command"] else "%s:%s" %(record["Stage"], os.path.basename(record["Command"].split(" ")[0]))
+    stage = stages.setdefault(name, {"count": 0, "wall_time": 0.0, "cpu_time": 0.0, "peak_rss_mb": 0.0})
+    stage["count"] += 1
+    stage["wall_time"] = round(stage["wall_time"] + record["Wall_Time"], 3)
+    stage["cpu_time"] = round(stage["cpu_time"] + record["CPU_Time"], 3)
+    stage["peak_rss_mb"] = max(stage["peak_rss_mb"], record["Peak_RSS_MB"])
+
+  with open(os.path.join(output_dir, PROFILE_JSON_FILE_NAME), "w") as pf:
+    json.dump({"summary": summary, "stages": stages, "records": records}, pf, indent=2)
+
+  with open(os.path.join(output_dir, PROFILE_CSV_FILE_NAME), "wb") as pf:
+    writer = csv.DictWriter(pf, fieldnames=PROFILE_FILE_HEADER)
+    writer.writeheader()
+    for record in records:
+      writer.writerow(record)
+
+def getInputGenomeIds(job_data, output_dir):
+  #Genome ids come from the job or from the genome group, a workspace JSON object listing them
+  if job_data["input_source"] == "id_list":
+    genome_ids = job_data["input_id_list"]
+    if not isinstance(genome_ids, list):
+      genome_ids = re.split(r"[\s,]+", genome_ids)
+  else:
+    group_file = os.path.join(output_dir, "genome_group.json")
+    runExternalCommand(["p3-cp", "ws:%s" %(job_data["input_genome_group"]), group_file], "fasta_fetch")
+    with open(group_file) as gf:
+      genome_ids = json.load(gf)["id_list"]["genome_id"]
+    os.remove(group_file)
+
+  return list(OrderedDict((genome_id.strip(), None) for genome_id in genome_ids if genome_id.strip()).keys())
+
+def getDataAPIConnection(url):
+  #Every fetch thread keeps one persistent connection per data API host
+  parsed_url = urlparse(url)
+  connections = DATA_API_CONNECTIONS.__dict__.setdefault("connections", {})
+  key = (parsed_url.scheme, parsed_url.netloc)
+  if key not in connections:
+    connection_class = HTTPSConnection if parsed_url.scheme == "https" else HTTPConnection
+    connections[key] = connection_class(parsed_url.netloc, timeout=DATA_API_TIMEOUT)
+  return connections[key]
+
+def queryDataAPI(data_api, collection, query):
+  #POST an RQL query and return the JSON records. Connection errors and server errors are retried,
+  #other HTTP errors are raised as RuntimeError.
+  url = "%s/%s/" %(data_api.rstrip("/"), collection)
+  headers = {"Content-Type": "application/rqlquery+x-www-form-urlencoded", "Accept": "application/json"}
+  if os.getenv("KB_AUTH_TOKEN"):
+    headers["Authorization"] = os.getenv("KB_AUTH_TOKEN")
+
+  for attempt in range(DATA_API_RETRIES + 1):
+    connection = getDataAPIConnection(url)
+    try:
+      connection.request("POST", urlparse(url).path, query, headers)
+      response = connection.getresponse()
+      body = response.read()
+      if response.status >= 500:
+        raise IOError("%s returned HTTP %d" %(url, response.status))
+      if response.status != 200:
+        raise RuntimeError("%s returned HTTP %d: %s" %(url, response.status, body[:200]))
+      return json.loads(body.decode("utf-8"))
+    except (IOError, HTTPException) as e:
+      #Reconnect on the next attempt
+      connection.close()
+      if attempt == DATA_API_RETRIES:
+        raise
+      print("Retrying data API request in %d seconds:\n %s" %(2 ** attempt, e))
+      time.sleep(2 ** attempt)
+
+def fetchGenomeSequencesTask(task):
+  data_api, genome_ids = task
+  query = "in(genome_id,(%s))&select(genome_id,accession,segment,sequence)&sort(+genome_id,+accession)&limit(%d)" %(",".join(quote(genome_id, safe="") for genome_id in genome_ids), DATA_API_LIMIT)
+  start_time = time.time()
+  records = queryDataAPI(data_api, "genome_sequence", query)
+  if len(records) >= DATA_API_LIMIT:
+    raise RuntimeError("Data API returned %d sequences or more for %d genomes, reduce the batch size" %(DATA_API_LIMIT, len(genome_ids)))
+  addProfileRecord("", "data_api_fetch", "genome_sequence %d genomes" %(len(genome_ids)), time.time() - start_time, 0, getPeakRSS())
+  return records
+
+def fetchGenomeSequences(data_api, genome_ids, input_file, batch_size, workers):
+  #Fetch sequences of the genomes in batches with bounded concurrency and stream them to the input file in genome order.
+  #Genome ids are the sample identifiers and segments the sequence suffixes, as in the FASTA headers of user files.
+  segment_numbers = dict((name, number) for number, name in SEGMENT_MAP.items())
+  tasks = [(data_api, genome_ids[i:i + batch_size]) for i in range(0, len(genome_ids), batch_size)]
+  fetched_genomes = set()
+  sequence_count = 0
+  pool = ThreadPool(max(1, min(workers, len(tasks))))
+  try:
+    with open(input_file, "w") as ff:
+      for records in pool.imap(fetchGenomeSequencesTask, tasks):
+        for record in records:
+          segment = str(record.get("segment") or "").strip()
+          segment = segment_numbers.get(segment.upper(), segment)
+          ff.write(toNativeString(u">Unique_Sample_Identifier:%s|Unique_Sequence_Identifier:%s-%s\n%s\n" %(record["genome_id"], record["genome_id"], segment, record["sequence"])))
+          fetched_genomes.add(record["genome_id"])
+          sequence_count += 1
+  finally:
+    pool.close()
+    pool.join()
+
+  missing_genomes = [genome_id for genome_id in genome_ids if genome_id not in fetched_genomes]
+  if missing_genomes:
+    print("No sequences found for %d genomes: %s" %(len(missing_genomes), ", ".join(missing_genomes[:10])))
+  print("Fetched %d sequences of %d genomes from the data API" %(sequence_count, len(fetched_genomes)))
+
+def createFASTAFile(output_dir, job_data, data_api_options):
   input_file = os.path.join(output_dir, "input.fasta")
   if job_data["input_source"] == "fasta_file":
     #Fetch input file from workspace
     try:
       fetch_fasta_cmd = ["p3-cp", "ws:%s" %(job_data["input_fasta_file"]), input_file]
-      subprocess.check_call(fetch_fasta_cmd, shell=False)
+      runExternalCommand(fetch_fasta_cmd, "fasta_fetch")
     except Exception as e:
       print("Error copying fasta file from workspace:\n %s" %(e))
       sys.exit(-1)
@@ -72,51 +441,178 @@ def createFASTAFile(output_dir, job_data):
     except Exception as e:
       print("Error copying fasta data to input file:\n %s" %(e))
       sys.exit(-1)
+  elif job_data["input_source"] in ("id_list", "genome_group"):
+    if not data_api_options["url"]:
+      print("The data API URL is required for %s inputs" %(job_data["input_source"]))
+      sys.exit(-1)
+    #Fetch genome sequences from the data API
+    try:
+      genome_ids = getInputGenomeIds(job_data, output_dir)
+      fetchGenomeSequences(data_api_options["url"], genome_ids, input_file, data_api_options["batch_size"], data_api_options["workers"])
+    except Exception as e:
+      print("Error fetching sequences from the data API:\n %s" %(e))
+      sys.exit(-1)
 
   return input_file
 
-def parseMetadataFile(metadata_file):
-  data = {} 
+def parseMetadataFile(metadata_file, normalization_index=None):
+  #Keep metadata order so that samples are processed and reported deterministically
+  data = OrderedDict()
 
   mf = open(metadata_file)
 
   reader = csv.DictReader(codecs.EncodedFile(mf, 'utf8', 'utf_8_sig'))
   for row in reader:
     val = {"fasta": [], "row": row, "header": reader.fieldnames}
-    data[row["Sample Identifier"].strip()] = val
+    #Problems found by normalization are reported by validateSubmission
+    if normalization_index is not None:
+      val["normalization"] = normalizeMetadataRow(normalization_index, row)
+    #Missing column and duplicate samples are reported by validateSubmission
+    sample_identifier = (row.get("Sample Identifier") or "").strip()
+    if sample_identifier in data:
+      val["duplicate"] = True
+    data[sample_identifier] = val
 
   mf.close()
   
   return data
 
-def parseFASTAFile(fasta_data):
-  for line in fasta_data:
-    if line[0] == ">":
-      header = line[1:].rstrip()
-      ids = header.split("|")
-      sample_id = ids[0].replace("Unique_Sample_Identifier:", "").strip()
-      sequence_id = ids[1].replace("Unique_Sequence_Identifier:", "").strip()
-      break
+def indexFASTAFile(fasta_file):
+  #Build a byte offset index of the records, similar to a .fai index, without keeping sequences in memory
+  with open(fasta_file, "rb") as ff:
+    entry = None
+    offset = 0
+    for line in ff:
+      if line.startswith(">"):
+        if entry is not None:
+          entry["length"] = offset - entry["offset"]
+          yield entry
+
+        header = line[1:].rstrip()
+        ids = header.split("|")
+        sample_id = ids[0].replace("Unique_Sample_Identifier:", "").strip()
+        sequence_id = ids[1].replace("Unique_Sequence_Identifier:", "").strip() if len(ids) > 1 else ""
+        entry = {"sample_id": sample_id, "sequence_id": sequence_id, "header": header, "offset": offset + len(line), "residues": 0}
+      elif entry is not None:
+        #length is the byte span of the record, residues excludes line breaks and other whitespace
+        entry["residues"] += len("".join(line.split()))
+
+      offset += len(line)
+
+    if entry is not None:
+      entry["length"] = offset - entry["offset"]
+      yield entry
+
+def readFASTARecords(fasta_file, entries):
+  #Read sequences of the indexed records lazily from the memory mapped input file
+  with open(fasta_file, "rb") as ff:
+    mm = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for entry in entries:
+        lines = mm[entry["offset"]:entry["offset"] + entry["length"]].splitlines()
+        record = dict(entry)
+        record["data"] = "".join(line.rstrip() for line in lines).replace(" ", "").replace("\r", "")
+        yield record
+    finally:
+      mm.close()
+
+def parseCollectionDate(date):
+  #Parse date in the correct format, raises ValueError for unknown formats
+  dashCount = date.count('-')
+  if dashCount == 2:
+      year = date.rsplit('-', 1)[1];
+      if len(year) == 2:
+          date = datetime.strptime(date, '%d-%b-%y').strftime('%d-%b-%Y')
+      else:
+          date = datetime.strptime(date, '%d-%b-%Y').strftime('%d-%b-%Y')
+  elif dashCount == 1:
+      date = datetime.strptime(date, '%b-%y').strftime('%b-%Y')
+  elif dashCount == 0 and len(date) == 2 and date != 'U':
+      date = datetime.strptime(date, '%y').strftime('%Y')
+
+  return date
+
+def validateSubmission(sample_info, unmatched_entries, metadata_header):
+  #Check inputs in one pass before any external tool runs. Errors stop the job, warnings are only reported.
+  errors = []
+  warnings = []
+
+  missing_columns = [column for column in METADATA_REQUIRED_COLUMNS if column not in (metadata_header or [])]
+  if missing_columns:
+    errors.append(("", "", "Metadata is missing required columns: %s" %(", ".join(missing_columns))))
+
+  for entry in unmatched_entries:
+    if "|" not in entry["header"]:
+      errors.append(("", "", "FASTA header '%s' is not in the Unique_Sample_Identifier:<sample>|Unique_Sequence_Identifier:<sequence> format" %(entry["header"])))
+    else:
+      warnings.append((entry["sample_id"], entry["sequence_id"], "Sample does not exist in the metadata. Sequence will not be processed."))
 
-  data = []
-  for line in fasta_data:
-    if line[0] == ">":
-      yield {"sample_id": sample_id, "sequence_id": sequence_id, "header": header, "data": "".join(data).replace(" ", "").replace("\r", "")}
-      data = []
-      header = line[1:].rstrip()
-      ids = header.split("|")
-      sample_id = ids[0].replace("Unique_Sample_Identifier:", "").strip()
-      sequence_id = ids[1].replace("Unique_Sequence_Identifier:", "").strip()
+  sequence_ids = set()
+  for sample_identifier, value in sample_info.items():
+    row = value["row"]
+    if sample_identifier == "":
+      errors.append(("", "", "Metadata row has an empty Sample Identifier"))
+    if value.get("duplicate", False):
+      warnings.append((sample_identifier, "", "Sample is defined more than once in the metadata, the last row is used"))
+    if len(value["fasta"]) == 0:
+      errors.append((sample_identifier, "", "Sample has no sequences in the FASTA file"))
+
+    if missing_columns:
       continue
-    data.append(line.rstrip())
 
-  yield {"sample_id": sample_id, "sequence_id": sequence_id, "header": header, "data": "".join(data).replace(" ", "").replace("\r", "")}
-  #yield {"sample_id": sample_id, "sequence_id": sequence_id, "header": header, "data": data}
+    for level, message in value.get("normalization", []):
+      (errors if level == "ERROR" else warnings).append((sample_identifier, "", message))
+
+    organism = row["Organism"] or ""
+    if organism.strip().lower() not in DATABASE_MAP:
+      errors.append((sample_identifier, "", "Organism '%s' is not supported, expected one of: %s" %(organism, ", ".join(sorted(DATABASE_MAP.keys())))))
+
+    try:
+      date = parseCollectionDate(row["Collection Date"] or "")
+      if not COLLECTION_DATE_PATTERN.match(date):
+        warnings.append((sample_identifier, "", "Collection Date '%s' is not in a GenBank format (DD-Mon-YYYY, Mon-YYYY, YYYY)" %(row["Collection Date"])))
+    except ValueError:
+      errors.append((sample_identifier, "", "Collection Date '%s' is not in a supported format (DD-Mon-YYYY, Mon-YYYY, YYYY)" %(row["Collection Date"])))
+
+    for entry in value["fasta"]:
+      sequence_id = entry["sequence_id"]
+      if "|" not in entry["header"]:
+        errors.append((sample_identifier, "", "FASTA header '%s' is not in the Unique_Sample_Identifier:<sample>|Unique_Sequence_Identifier:<sequence> format" %(entry["header"])))
+        continue
+
+      if sequence_id in sequence_ids:
+        errors.append((sample_identifier, sequence_id, "Sequence identifier is used more than once"))
+      sequence_ids.add(sequence_id)
+
+      parts = sequence_id.split("-")
+      if len(parts) < 2:
+        errors.append((sample_identifier, sequence_id, "Sequence identifier does not end with -<segment>"))
+      elif parts[1] not in SEGMENT_MAP:
+        errors.append((sample_identifier, sequence_id, "Segment '%s' is not a valid segment number (1-8)" %(parts[1])))
+      elif sequence_id != "%s-%s" %(sample_identifier, parts[1]):
+        warnings.append((sample_identifier, sequence_id, "Sequence identifier does not match the <sample>-<segment> format"))
+
+      if entry["residues"] == 0:
+        warnings.append((sample_identifier, sequence_id, "Sequence is empty"))
+
+  return errors, warnings
+
+def writeInputValidationReport(report_file, errors, warnings):
+  with open(report_file, "wb") as rf:
+    writer = csv.DictWriter(rf, fieldnames=INPUT_VALIDATION_FILE_HEADER)
+    writer.writeheader()
+    for level, problems in (("ERROR", errors), ("WARNING", warnings)):
+      for sample_identifier, sequence_id, message in problems:
+        writer.writerow({"Level": level,
+                         "Sample_Identifier": sample_identifier,
+                         "Unique_Sequence_Identifier": sequence_id,
+                         "Message": message})
+        print("%s: %s" %(level, " ".join(part for part in (sample_identifier, sequence_id, message) if part)))
 
 def runFluValidator(fasta_file, validator_file):
   try:
     flu_validator_cmd = [FLUVALIDATOR, "-fasta", fasta_file]
-    output = subprocess.check_output(flu_validator_cmd, shell=False)
+    output = runExternalCommand(flu_validator_cmd, "flan", capture=True)
     with open(validator_file, "w") as f:
       f.write(output) 
   except Exception as e:
@@ -129,8 +625,8 @@ def runFluValidatorPerSegment(fasta_file):
   output_file_basename = os.path.splitext(os.path.basename(fasta_file))[0] + "_FLAN"
   try:
     #Generates $output_file_basename$.report and $output_file_basename$.tbl files 
-    flu_validator_cmd = [FLUVALIDATOR, "-fasta", fasta_file, "-v", "-tbl", "-o", output_file_basename]
-    subprocess.check_output(flu_validator_cmd, shell=False)
+    flu_validator_cmd = [FLUVALIDATOR, "-fasta", fasta_file, "-v", "-tbl", "-o", os.path.join(os.path.dirname(fasta_file), output_file_basename)]
+    runExternalCommand(flu_validator_cmd, "flan", capture=True)
   except Exception as e:
     print("Error running flu validator per segment for %s:\n %s" %(fasta_file, e))
     sys.exit(-1)
@@ -138,46 +634,559 @@ def runFluValidatorPerSegment(fasta_file):
   return output_file_basename
 
 def parseFluValidatorPerSegmentResult(report_file_path):
+  try:
+    with open(report_file_path, "r") as f:
+      return parseFluValidatorReportLines(f.readlines())
+  except Exception as e:
+    print("Error parsing flu validator report file %s:\n %s" %(report_file_path, e))
+
+  return {"message": ""}
+
+def parseFluValidatorReportLines(lines):
   result_map = {}
   message = ''
 
   try:
-    with open(report_file_path, "r") as f:
-      for line in f:
-        if not(line.startswith("\x1b[0m")):
-          line = line.strip()
-
-          if "Fasta" in line:
-            result_map["fasta_name"] = line.split(' ')[1]
-          elif "WARNING" in line or "ERROR" in line:
-            message += line + "\n"
-          elif "serotype" in line.lower():
-            result_map["serotype"] = line.split(':')[1].strip()
-          else:
-            segment_line = line.split()
-            
-            result_map["result"] = re.sub("\x1b\[[0-9]*m", "", segment_line[1])
-            result_map["segment"] = re.sub("[\[\]]", "", re.sub("\x1b\[[0-9]*m", "", segment_line[5]))
+    for line in lines:
+      if not(line.startswith("\x1b[0m")):
+        line = line.strip()
+
+        if "Fasta" in line:
+          result_map["fasta_name"] = line.split(' ')[1]
+        elif "WARNING" in line or "ERROR" in line:
+          message += line + "\n"
+        elif "serotype" in line.lower():
+          result_map["serotype"] = line.split(':')[1].strip()
+        else:
+          segment_line = line.split()
+          
+          result_map["result"] = re.sub("\x1b\[[0-9]*m", "", segment_line[1])
+          result_map["segment"] = re.sub("[\[\]]", "", re.sub("\x1b\[[0-9]*m", "", segment_line[5]))
   except Exception as e:
-    print("Error parsing flu validator report file %s:\n %s" %(report_file_path, e))
+    print("Error parsing flu validator report lines:\n %s" %(e))
 
   result_map["message"] = re.sub("\/0B", "", re.sub("\x1b\[[0-9]*m", "", message))
   return result_map
 
-def runVIGOR4(fasta_file, organism):
+def getFASTASequenceIds(fasta_file):
+  with open(fasta_file) as ff:
+    return [line[1:].split()[0] for line in ff if line.startswith(">") and len(line.split()) > 0]
+
+def runFluValidatorBatch(fasta_files, work_dir):
+  #Validate many segment FASTA files with a single fluValidator2 run and split the report per sequence
+  sequence_files = OrderedDict()
+  for fasta_file in fasta_files:
+    for sequence_id in getFASTASequenceIds(fasta_file):
+      sequence_files[sequence_id] = fasta_file
+
+  fd, batch_file = tempfile.mkstemp(prefix="flan_batch_", suffix=".fasta", dir=work_dir)
+  with os.fdopen(fd, "w") as bf:
+    for fasta_file in fasta_files:
+      with open(fasta_file) as ff:
+        shutil.copyfileobj(ff, bf)
+      bf.write("\n")
+
+  output_prefix = os.path.splitext(batch_file)[0] + "_FLAN"
+  report_lines = {}
+  try:
+    flu_validator_cmd = [FLUVALIDATOR, "-fasta", batch_file, "-v", "-tbl", "-o", output_prefix]
+    runExternalCommand(flu_validator_cmd, "flan", capture=True)
+
+    #Lines after a segment line belong to that sequence, lines before the first one to the first sequence
+    pending = []
+    sequence_id = None
+    with open(output_prefix + ".report") as rf:
+      for line in rf:
+        plain = re.sub("\x1b\[[0-9]*m", "", line).strip()
+        tokens = plain.split()
+        if tokens and tokens[0] in sequence_files and "Fasta" not in plain and "serotype" not in plain.lower():
+          sequence_id = tokens[0]
+          report_lines[sequence_id] = pending + report_lines.get(sequence_id, [])
+          pending = []
+        if sequence_id is None:
+          pending.append(line)
+        else:
+          report_lines[sequence_id].append(line)
+  except Exception as e:
+    print("Error running flu validator for batch %s:\n %s" %(batch_file, e))
+
+  #Keep per segment FLAN outputs next to the segment FASTA files
+  tbl_results = splitVIGOR4Output(output_prefix, list(sequence_files.keys()))
+  results = {}
+  for sequence_id, fasta_file in sequence_files.items():
+    output_file_basename = os.path.join(os.path.dirname(fasta_file), os.path.splitext(os.path.basename(fasta_file))[0] + "_FLAN")
+    if sequence_id in report_lines:
+      with open(output_file_basename + ".report", "w") as rf:
+        rf.write("".join(report_lines[sequence_id]))
+      with open(output_file_basename + ".tbl", "w") as tf:
+        tf.write(tbl_results[sequence_id]["tbl"])
+      results[sequence_id] = parseFluValidatorReportLines(report_lines[sequence_id])
+    else:
+      #Fall back to validating the segment on its own when it is missing from the batch report
+      try:
+        runFluValidatorPerSegment(fasta_file)
+        results[sequence_id] = parseFluValidatorPerSegmentResult(output_file_basename + ".report")
+      except SystemExit:
+        results[sequence_id] = {"message": "ERROR: Flu validator failed for %s" %(sequence_id)}
+
+  for f in glob.glob(os.path.splitext(batch_file)[0] + "*"):
+    os.remove(f)
+
+  return results
+
+def runFluValidatorServer(address, authkey, batch_size, batch_wait, work_dir):
+  #Long lived validator that collects requests from sample workers into batches
+  listener = Listener(address, authkey=authkey)
+  requests = queue.Queue()
+
+  def receiveRequests(connection):
+    try:
+      while True:
+        requests.put((connection, connection.recv()))
+    except (EOFError, IOError):
+      pass
+
+  def acceptConnections():
+    while True:
+      connection = listener.accept()
+      thread = threading.Thread(target=receiveRequests, args=(connection,))
+      thread.daemon = True
+      thread.start()
+
+  thread = threading.Thread(target=acceptConnections)
+  thread.daemon = True
+  thread.start()
+
+  while True:
+    batch = [requests.get()]
+    file_count = len(batch[0][1])
+    deadline = time.time() + batch_wait
+    while file_count < batch_size and time.time() < deadline:
+      try:
+        batch.append(requests.get(timeout=max(0, deadline - time.time())))
+        file_count += len(batch[-1][1])
+      except queue.Empty:
+        break
+
+    results = runFluValidatorBatch([fasta_file for connection, fasta_files in batch for fasta_file in fasta_files], work_dir)
+    #Command timings of the server are not reported, samples record their wait for the results instead
+    del PROFILE_RECORDS[:]
+    for connection, fasta_files in batch:
+      try:
+        connection.send(dict((sequence_id, results.get(sequence_id, {"message": ""})) for fasta_file in fasta_files for sequence_id in getFASTASequenceIds(fasta_file)))
+      except IOError as e:
+        print("Error sending flu validator results:\n %s" %(e))
+
+def startFluValidatorServer(batch_size, batch_wait):
+  work_dir = tempfile.mkdtemp(prefix="flan_server_")
+  server = {"address": os.path.join(work_dir, "flan.sock"), "authkey": os.urandom(16), "work_dir": work_dir}
+  server["process"] = multiprocessing.Process(target=runFluValidatorServer, args=(server["address"], server["authkey"], batch_size, batch_wait, work_dir))
+  server["process"].daemon = True
+  server["process"].start()
+
+  #Wait for the listener socket
+  while not os.path.exists(server["address"]) and server["process"].is_alive():
+    time.sleep(0.05)
+
+  return server
+
+def stopFluValidatorServer(server):
+  server["process"].terminate()
+  server["process"].join()
+  shutil.rmtree(server["work_dir"], ignore_errors=True)
+
+def requestFluValidation(server, fasta_files):
+  connection = Client(server["address"], authkey=server["authkey"])
+  try:
+    connection.send(fasta_files)
+    return connection.recv()
+  finally:
+    connection.close()
+
+def runVIGOR4(fasta_file, organism, output_dir, reference_db=None):
   fasta_file_name = os.path.splitext(os.path.basename(fasta_file))[0] 
   database = DATABASE_MAP[organism.lower()]
 
-  #Run VIGOR4 for the database
+  #Run VIGOR4 for the database, output files are prefixed with the output folder.
+  #Reference databases are read from the staged local copy when there is one.
   try:
-    vigor4_cmd = ["vigor4", "-i", fasta_file, "-o", fasta_file_name, "-d", database] 
-    subprocess.check_call(vigor4_cmd, shell=False)
+    vigor4_cmd = ["vigor4", "-i", fasta_file, "-o", os.path.join(output_dir, fasta_file_name), "-d", database] 
+    if reference_db:
+      vigor4_cmd += ["--reference-database-path", reference_db]
+    runExternalCommand(vigor4_cmd, "vigor4")
   except Exception as e:
     print("Error running VIGOR4 for %s using database %s:\n %s" %(fasta_file, database, e))
     return False
 
   return True
 
+def getVIGOR4Status(is_successful, tbl_file):
+  if not is_successful:
+    return "Failed"
+
+  if os.path.isfile(tbl_file):
+    if os.path.getsize(tbl_file) > 0:
+      return "Processed"
+    else:
+      return "No Annotation"
+
+  return "Error"
+
+def findVIGOR4SequenceId(identifier, sequence_ids):
+  #VIGOR4 names features as <sequence id>.<n>, pick the longest sequence id matching the identifier
+  match = None
+  for sequence_id in sequence_ids:
+    if identifier == sequence_id or identifier.startswith(sequence_id + "."):
+      if match is None or len(sequence_id) > len(match):
+        match = sequence_id
+
+  return match
+
+def splitVIGOR4Output(output_prefix, sequence_ids):
+  results = OrderedDict((sequence_id, {"tbl": "", "cds": "", "gff3": ""}) for sequence_id in sequence_ids)
+
+  #tbl file is made of ">Features <sequence id>" blocks
+  tbl_file = output_prefix + ".tbl"
+  if os.path.isfile(tbl_file):
+    with open(tbl_file) as tf:
+      sequence_id = None
+      for line in tf:
+        if line.startswith(">Features"):
+          sequence_id = findVIGOR4SequenceId(line.split()[1], sequence_ids) if len(line.split()) > 1 else None
+        if sequence_id is not None:
+          results[sequence_id]["tbl"] += line
+
+  #cds file is a FASTA file with one record per feature
+  cds_file = output_prefix + ".cds"
+  if os.path.isfile(cds_file):
+    with open(cds_file) as cf:
+      sequence_id = None
+      for line in cf:
+        if line.startswith(">"):
+          sequence_id = findVIGOR4SequenceId(line[1:].split()[0], sequence_ids) if len(line) > 1 else None
+        if sequence_id is not None:
+          results[sequence_id]["cds"] += line
+
+  #gff3 file starts with directives followed by features where the first column is the sequence id
+  gff3_file = output_prefix + ".gff3"
+  if os.path.isfile(gff3_file):
+    with open(gff3_file) as gf:
+      directives = ""
+      sequence_id = None
+      for line in gf:
+        if line.startswith("#"):
+          if sequence_id is None:
+            directives += line
+          else:
+            results[sequence_id]["gff3"] += line
+          continue
+
+        sequence_id = findVIGOR4SequenceId(line.split("\t")[0], sequence_ids)
+        if sequence_id is not None:
+          if results[sequence_id]["gff3"] == "":
+            results[sequence_id]["gff3"] = directives
+          results[sequence_id]["gff3"] += line
+
+  return results
+
+def mergeVIGOR4Results(results):
+  merged = {"tbl": "", "cds": "", "gff3": ""}
+  for result in results:
+    merged["tbl"] += result["tbl"]
+    merged["cds"] += result["cds"]
+
+    #Keep gff3 directives only from the first result
+    gff3 = result["gff3"]
+    if merged["gff3"] != "":
+      gff3 = "".join(line for line in gff3.splitlines(True) if not line.startswith("##gff-version"))
+    merged["gff3"] += gff3
+
+  return merged
+
+def readVIGOR4Result(output_prefix):
+  result = {}
+  for extension in VIGOR4_OUTPUT_EXTENSIONS:
+    with open(output_prefix + "." + extension) as f:
+      result[extension] = f.read()
+
+  return result
+
+def writeVIGOR4Result(output_prefix, result):
+  for extension in VIGOR4_OUTPUT_EXTENSIONS:
+    with open(output_prefix + "." + extension, "w") as f:
+      f.write(result[extension])
+
+def renameVIGOR4Result(result, old_id, new_id):
+  if old_id == new_id:
+    return result
+
+  renamed = {"tbl": "", "cds": "", "gff3": ""}
+  for line in result["tbl"].splitlines(True):
+    if line.startswith(">Features") and len(line.split()) > 1 and line.split()[1] == old_id:
+      line = line.replace(old_id, new_id, 1)
+    renamed["tbl"] += line
+
+  for line in result["cds"].splitlines(True):
+    if line.startswith(">" + old_id) and findVIGOR4SequenceId(line[1:].split()[0], [old_id]) is not None:
+      line = ">" + new_id + line[len(old_id) + 1:]
+    renamed["cds"] += line
+
+  #Rename the sequence column and the feature ids in the attributes column
+  attribute_pattern = re.compile("(?<=[=,])" + re.escape(old_id) + "(?=[.;,\\s]|$)")
+  for line in result["gff3"].splitlines(True):
+    if not line.startswith("#"):
+      columns = line.split("\t")
+      if columns[0] == old_id:
+        columns[0] = new_id
+      columns[-1] = attribute_pattern.sub(new_id.replace("\\", "\\\\"), columns[-1])
+      line = "\t".join(columns)
+    renamed["gff3"] += line
+
+  return renamed
+
+def getSequenceHash(sequence):
+  return hashlib.sha256(sequence.upper()).hexdigest()
+
+def getAnnotationCachePath(cache_dir, sequence_hash, database):
+  #Key is made of the sequence hash, VIGOR4 database and the reference database path holding the VIGOR4 version
+  key = hashlib.sha256("\0".join([sequence_hash, database, VIGOR_REF_DB])).hexdigest()
+  return os.path.join(cache_dir, key[:2], key + ".json")
+
+def lookupAnnotationCache(cache_dir, sequence_hash, database, sequence_id):
+  cache_file = getAnnotationCachePath(cache_dir, sequence_hash, database)
+  try:
+    with open(cache_file) as cf:
+      result = json.load(cf)
+  except (IOError, OSError, ValueError):
+    return None
+
+  #Update modification time for LRU eviction
+  try:
+    os.utime(cache_file, None)
+  except OSError:
+    pass
+
+  return renameVIGOR4Result(result, ANNOTATION_CACHE_SEQUENCE_ID, sequence_id)
+
+def writeFileAtomically(target_file, write_content, mode="w"):
+  #Write to a temporary file next to the target first so that readers never see a partial file
+  fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(target_file), suffix=".tmp")
+  try:
+    with os.fdopen(fd, mode) as tf:
+      write_content(tf)
+    #mkstemp creates the file readable by the owner only, give it the permissions of a file created with open
+    os.chmod(temp_file, 0o666 & ~FILE_UMASK)
+    os.rename(temp_file, target_file)
+  finally:
+    if os.path.exists(temp_file):
+      os.remove(temp_file)
+
+def setUmaskPermissions(temp_dir):
+  #mkdtemp creates the folder accessible by the owner only, give it and its files the permissions of os.makedirs and open
+  os.chmod(temp_dir, 0o777 & ~FILE_UMASK)
+  for file_name in os.listdir(temp_dir):
+    os.chmod(os.path.join(temp_dir, file_name), 0o666 & ~FILE_UMASK)
+
+def storeAnnotationCache(cache_dir, sequence_hash, database, sequence_id, result):
+  cache_file = getAnnotationCachePath(cache_dir, sequence_hash, database)
+  try:
+    if not os.path.isdir(os.path.dirname(cache_file)):
+      os.makedirs(os.path.dirname(cache_file))
+
+    writeFileAtomically(cache_file, lambda cf: json.dump(renameVIGOR4Result(result, sequence_id, ANNOTATION_CACHE_SEQUENCE_ID), cf))
+  except (IOError, OSError) as e:
+    print("Error storing annotation of %s in cache:\n %s" %(sequence_id, e))
+
+def getFileDigest(file_path):
+  #Reading the whole file also brings it into the page cache
+  digest = hashlib.sha256()
+  with open(file_path, "rb") as ff:
+    for block in iter(lambda: ff.read(1024 * 1024), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def copyReferenceFile(source_file, target_file):
+  #Copy through a temporary file and return the checksum of the source computed while copying
+  digest = hashlib.sha256()
+  def copyContent(tf):
+    with open(source_file, "rb") as sf:
+      for block in iter(lambda: sf.read(1024 * 1024), b""):
+        digest.update(block)
+        tf.write(block)
+    os.fchmod(tf.fileno(), os.stat(source_file).st_mode & 0o7777)
+  writeFileAtomically(target_file, copyContent, "wb")
+  return digest.hexdigest()
+
+def stageReferenceDatabases(databases, stage_dir):
+  #Copy the VIGOR4 reference databases of the job from shared storage to node local storage. Copies are kept
+  #for later jobs while their source is unchanged, and every job verifies them by checksum, which warms the page cache.
+  manifest_file = os.path.join(stage_dir, REFERENCE_DB_MANIFEST_FILE_NAME)
+  try:
+    with open(manifest_file) as mf:
+      manifest = json.load(mf)
+  except (IOError, OSError, ValueError):
+    manifest = {}
+
+  counters = {"copied": 0, "verified": 0}
+  for database in sorted(databases):
+    for source in sorted(glob.glob(os.path.join(VIGOR_REF_DB, database + "_db*"))):
+      source_files = [source] if os.path.isfile(source) else [os.path.join(root, name) for root, dirs, names in os.walk(source) for name in names]
+      for source_file in source_files:
+        relative_path = os.path.relpath(source_file, VIGOR_REF_DB)
+        target_file = os.path.join(stage_dir, relative_path)
+        source_stat = os.stat(source_file)
+        entry = manifest.get(relative_path)
+        if entry and entry["size"] == source_stat.st_size and entry["mtime"] == source_stat.st_mtime and os.path.exists(target_file) and getFileDigest(target_file) == entry["sha256"]:
+          counters["verified"] += 1
+          continue
+
+        if not os.path.isdir(os.path.dirname(target_file)):
+          os.makedirs(os.path.dirname(target_file))
+        digest = copyReferenceFile(source_file, target_file)
+        if getFileDigest(target_file) != digest:
+          raise IOError("Checksum of the staged copy of %s does not match" %(source_file))
+        manifest[relative_path] = {"size": source_stat.st_size, "mtime": source_stat.st_mtime, "sha256": digest}
+        counters["copied"] += 1
+
+  writeFileAtomically(manifest_file, lambda mf: json.dump(manifest, mf))
+
+  return counters
+
+def evictAnnotationCache(cache_dir, max_size):
+  entries = []
+  total_size = 0
+  for root, dirs, files in os.walk(cache_dir):
+    for filename in files:
+      f = os.path.join(root, filename)
+      try:
+        stat = os.stat(f)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, f))
+      total_size += stat.st_size
+
+  #Remove least recently used entries until the cache is under its size cap
+  evicted = 0
+  for mtime, size, f in sorted(entries):
+    if total_size <= max_size:
+      break
+    try:
+      os.remove(f)
+      total_size -= size
+      evicted += 1
+    except OSError:
+      pass
+
+  return evicted
+
+def writeSampleVIGOR4Results(sample_dir, sample_identifier, results):
+  for sequence_id, result in results:
+    writeVIGOR4Result(os.path.join(sample_dir, sequence_id), result)
+  writeVIGOR4Result(os.path.join(sample_dir, sample_identifier), mergeVIGOR4Results(result for sequence_id, result in results))
+
+def runVIGOR4ChunkTask(task):
+  fasta_file, organism, output_dir, reference_db = task
+  start_index = len(PROFILE_RECORDS)
+  is_successful = runVIGOR4(fasta_file, organism, output_dir, reference_db)
+  return is_successful, collectProfileRecords(start_index)
+
+def runVIGOR4Batch(sample_info, sequence_validation_dir, options, pool):
+  input_file = options["input_file"]
+  cache_dir = options["annotation_cache"]
+  counters = {"cache_hits": 0, "cache_misses": 0, "annotations_saved": 0}
+  annotated = set()
+
+  #Group sequences of all samples by VIGOR4 database, results are written to the sample folders as they become available
+  groups = OrderedDict()
+  for sample_identifier, value in sample_info.items():
+    organism = value["row"].get("Organism", "")
+    if organism.lower() not in DATABASE_MAP:
+      print("Organism %s of sample %s is not supported by VIGOR4 batch annotation. Passing." %(organism, sample_identifier))
+      continue
+
+    sample_dir = os.path.join(sequence_validation_dir, sample_identifier)
+    if not os.path.isdir(sample_dir):
+      os.mkdir(sample_dir)
+
+    database = DATABASE_MAP[organism.lower()]
+    if database not in groups:
+      groups[database] = {"organism": organism, "records": OrderedDict()}
+    sequence_hashes = [getSequenceHash(fasta["data"]) for fasta in readFASTARecords(input_file, value["fasta"])]
+    for fasta, sequence_hash in zip(value["fasta"], sequence_hashes):
+      if cache_dir:
+        result = lookupAnnotationCache(cache_dir, sequence_hash, database, fasta["sequence_id"])
+        if result is not None:
+          writeVIGOR4Result(os.path.join(sample_dir, fasta["sequence_id"]), result)
+          annotated.add((sample_identifier, fasta["sequence_id"]))
+          counters["cache_hits"] += 1
+          continue
+        counters["cache_misses"] += 1
+
+      #Identical sequences across samples are annotated once, the first record stands for the others
+      groups[database]["records"].setdefault(sequence_hash, []).append((sample_identifier, fasta["sequence_id"], sequence_hash, fasta))
+
+  batch_dir = tempfile.mkdtemp(prefix="vigor4_batch_", dir=os.path.dirname(sequence_validation_dir))
+
+  #Write chunked FASTA files, using smaller chunks when there would be fewer chunks than workers
+  chunks = []
+  for database, group in groups.items():
+    records = [duplicates[0] for duplicates in group["records"].values()]
+    counters["annotations_saved"] += sum(len(duplicates) for duplicates in group["records"].values()) - len(records)
+    chunk_size = max(1, min(options["vigor_batch_size"], (len(records) + options["workers"] - 1) // options["workers"]))
+    for start in range(0, len(records), chunk_size):
+      chunk_records = records[start:start + chunk_size]
+      chunk_file = os.path.join(batch_dir, "%s_%d.fasta" %(database, len(chunks)))
+      with open(chunk_file, "w") as cf:
+        for fasta in readFASTARecords(input_file, [record[3] for record in chunk_records]):
+          cf.write(">" + fasta["sequence_id"] + "\n" + fasta["data"] + "\n")
+      chunks.append({"file": chunk_file, "organism": group["organism"], "database": database, "records": chunk_records})
+
+  print("Running VIGOR4 for %d unique sequences in %d chunks, %d duplicate sequences are not annotated again" %(sum(len(chunk["records"]) for chunk in chunks), len(chunks), counters["annotations_saved"]))
+  tasks = [(chunk["file"], chunk["organism"], batch_dir, options["reference_db"]) for chunk in chunks]
+  if pool is not None:
+    chunk_results = pool.map(runVIGOR4ChunkTask, tasks)
+  else:
+    chunk_results = [runVIGOR4ChunkTask(task) for task in tasks]
+
+  statuses = []
+  for is_successful, records in chunk_results:
+    statuses.append(is_successful)
+    PROFILE_RECORDS.extend(records)
+
+  #Route chunk results back to the samples
+  for chunk, is_successful in zip(chunks, statuses):
+    if not is_successful:
+      continue
+
+    sequence_ids = [record[1] for record in chunk["records"]]
+    results = splitVIGOR4Output(os.path.splitext(chunk["file"])[0], sequence_ids)
+    for representative_sample, representative_id, sequence_hash, fasta in chunk["records"]:
+      for sample_identifier, sequence_id, sequence_hash, fasta in groups[chunk["database"]]["records"][sequence_hash]:
+        writeVIGOR4Result(os.path.join(sequence_validation_dir, sample_identifier, sequence_id), renameVIGOR4Result(results[representative_id], representative_id, sequence_id))
+        annotated.add((sample_identifier, sequence_id))
+      if cache_dir:
+        storeAnnotationCache(cache_dir, sequence_hash, chunk["database"], representative_id, results[representative_id])
+
+  shutil.rmtree(batch_dir)
+
+  #Create sample level files for samples with all sequences annotated
+  failed_samples = 0
+  for sample_identifier, value in sample_info.items():
+    sequence_ids = [fasta["sequence_id"] for fasta in value["fasta"]]
+    if not all((sample_identifier, sequence_id) in annotated for sequence_id in sequence_ids):
+      failed_samples += 1
+      continue
+
+    sample_dir = os.path.join(sequence_validation_dir, sample_identifier)
+    results = [readVIGOR4Result(os.path.join(sample_dir, sequence_id)) for sequence_id in sequence_ids]
+    writeVIGOR4Result(os.path.join(sample_dir, sample_identifier), mergeVIGOR4Results(results))
+    value["vigor_annotated"] = True
+
+  if failed_samples:
+    print("VIGOR4 batch annotation failed for %d samples, they will be annotated individually." %(failed_samples))
+
+  return counters
+
 def parseCDSFile(cds_file_path):
   result = {}
 
@@ -192,7 +1201,490 @@ def parseCDSFile(cds_file_path):
 
   return result
 
-def createSubmissionXML(submission_file, sample_identifier, date):
+def buildQCTables():
+  class_table = [QC_INVALID] * 256
+  for bases, qc_class in (("ACGT", QC_VALID), ("N", QC_N), ("RYSWKMBDHV", QC_AMBIGUOUS)):
+    for base in bases + bases.lower():
+      class_table[ord(base)] = qc_class
+
+  base_table = [4] * 256
+  for index, base in enumerate("ACGT"):
+    base_table[ord(base)] = base_table[ord(base.lower())] = index
+
+  stop_table = [False] * 64
+  for codon in STOP_CODONS:
+    stop_table["ACGT".index(codon[0]) * 16 + "ACGT".index(codon[1]) * 4 + "ACGT".index(codon[2])] = True
+
+  if np is not None:
+    return np.array(class_table, dtype=np.uint8), np.array(base_table, dtype=np.uint8), np.array(stop_table, dtype=bool)
+  return class_table, base_table, stop_table
+
+QC_CLASS_TABLE, QC_BASE_TABLE, QC_STOP_TABLE = buildQCTables()
+
+def countInternalStops(cds_sequence):
+  codon_count = len(cds_sequence) // 3
+  if codon_count < 2:
+    return 0
+
+  #Last codon is the expected stop codon, codons with ambiguous bases are ignored
+  if np is not None:
+    bases = QC_BASE_TABLE[np.frombuffer(cds_sequence[:codon_count * 3], dtype=np.uint8)].reshape(-1, 3)
+    is_valid = (bases < 4).all(axis=1)
+    codons = (bases[:, 0].astype(np.int64) * 16 + bases[:, 1] * 4 + bases[:, 2]) % 64
+    return int((QC_STOP_TABLE[codons] & is_valid)[:-1].sum())
+
+  sequence = cds_sequence.upper()
+  return sum(1 for i in range(0, (codon_count - 1) * 3, 3) if sequence[i:i + 3] in STOP_CODONS)
+
+def parseCDSSequences(cds_file_path):
+  sequences = []
+
+  if os.path.isfile(cds_file_path):
+    with open(cds_file_path) as cf:
+      for line in cf:
+        if line.startswith(">"):
+          sequences.append("")
+        elif sequences:
+          sequences[-1] += line.strip()
+
+  return sequences
+
+def computeSequenceQC(records, database, sample_dir):
+  #Classify every base of the sample at once and derive per sequence counts from cumulative sums
+  sequences = [record["data"] for record in records]
+  lengths = [len(sequence) for sequence in sequences]
+  starts = [0]
+  for length in lengths:
+    starts.append(starts[-1] + length)
+
+  invalid_positions = [[] for sequence in sequences]
+  if np is not None:
+    classes = QC_CLASS_TABLE[np.frombuffer("".join(sequences), dtype=np.uint8)]
+    boundaries = np.array(starts)
+
+    def countClass(qc_class):
+      cumulative = np.concatenate(([0], np.cumsum(classes == qc_class)))
+      return cumulative[boundaries[1:]] - cumulative[boundaries[:-1]]
+
+    n_counts = countClass(QC_N)
+    ambiguous_counts = countClass(QC_AMBIGUOUS)
+    invalid = np.nonzero(classes == QC_INVALID)[0]
+    owners = np.searchsorted(boundaries, invalid, side="right") - 1
+    for position, owner in zip(invalid, owners):
+      invalid_positions[owner].append(int(position - starts[owner]) + 1)
+  else:
+    n_counts = [sequence.upper().count("N") for sequence in sequences]
+    ambiguous_counts = [sum(sequence.upper().count(base) for base in "RYSWKMBDHV") for sequence in sequences]
+    for index, sequence in enumerate(sequences):
+      invalid_positions[index] = [match.start() + 1 for match in QC_INVALID_PATTERN.finditer(sequence)]
+
+  qc_rows = []
+  for index, record in enumerate(records):
+    sequence = sequences[index]
+    length = lengths[index]
+    flags = []
+
+    segment = record["sequence_id"].split("-")[1] if "-" in record["sequence_id"] else ""
+    length_range = SEGMENT_LENGTH_RANGES.get(database, {}).get(segment)
+    if length_range and not (length_range[0] <= length <= length_range[1]):
+      flags.append("LENGTH_OUT_OF_RANGE")
+
+    n_fraction = float(n_counts[index]) / length if length else 0.0
+    ambiguous_fraction = float(ambiguous_counts[index]) / length if length else 0.0
+    if n_fraction + ambiguous_fraction > QC_MAX_AMBIGUOUS_FRACTION:
+      flags.append("HIGH_AMBIGUITY")
+    if length and (sequence[0] in "Nn" or sequence[-1] in "Nn"):
+      flags.append("TERMINAL_N")
+    if invalid_positions[index]:
+      flags.append("INVALID_CHARACTERS")
+    if length == 0:
+      flags.append("EMPTY_SEQUENCE")
+
+    internal_stops = sum(countInternalStops(cds) for cds in parseCDSSequences(os.path.join(sample_dir, record["sequence_id"] + ".cds")))
+    if internal_stops:
+      flags.append("INTERNAL_STOP")
+
+    invalid_characters = ", ".join("%s:%d" %(sequence[position - 1], position) for position in invalid_positions[index][:QC_MAX_REPORTED_POSITIONS])
+    if len(invalid_positions[index]) > QC_MAX_REPORTED_POSITIONS:
+      invalid_characters += ", ... (%d total)" %(len(invalid_positions[index]))
+
+    qc_rows.append({"Length": length,
+                    "Expected_Length": "%d-%d" %(length_range) if length_range else "",
+                    "N_Fraction": "%.4f" %(n_fraction),
+                    "Ambiguous_Fraction": "%.4f" %(ambiguous_fraction),
+                    "Invalid_Characters": invalid_characters,
+                    "Internal_Stops": internal_stops,
+                    "QC_Flags": ", ".join(flags)})
+
+  return qc_rows
+
+def readBlastNucleotideDB(db_path):
+  #Decode sequences of a BLAST version 4 nucleotide database. Ambiguous bases are kept as their 2-bit placeholder.
+  with open(db_path + ".nin", "rb") as nf:
+    index = nf.read()
+
+  offset = 8
+  for i in range(2):
+    offset += 4 + struct.unpack(">I", index[offset:offset + 4])[0]
+  sequence_count = struct.unpack(">I", index[offset:offset + 4])[0]
+  offset += 16 + 4 * (sequence_count + 1)
+  sequence_offsets = struct.unpack(">%dI" %(sequence_count + 1), index[offset:offset + 4 * (sequence_count + 1)])
+  offset += 4 * (sequence_count + 1)
+  ambiguity_offsets = struct.unpack(">%dI" %(sequence_count + 1), index[offset:offset + 4 * (sequence_count + 1)])
+
+  byte_table = ["".join("ACGT"[(byte >> shift) & 3] for shift in (6, 4, 2, 0)) for byte in range(256)]
+  with open(db_path + ".nsq", "rb") as sf:
+    data = sf.read()
+
+  for oid in range(sequence_count):
+    packed = bytearray(data[sequence_offsets[oid]:ambiguity_offsets[oid]])
+    if len(packed) == 0:
+      continue
+    #Last byte holds the number of bases it contains in its two lowest bits
+    yield oid, "".join(byte_table[byte] for byte in packed[:-1]) + byte_table[packed[-1]][:packed[-1] & 3]
+
+def readBlastAccessions(db_path):
+  #The .nsd file maps lower case accessions to ordinal ids
+  accessions = {}
+  with open(db_path + ".nsd", "rb") as nf:
+    for line in nf:
+      accession, separator, oid = line.rstrip("\n").partition("\x02")
+      if separator and "." not in accession:
+        accessions[int(oid)] = accession.upper()
+
+  return accessions
+
+def loadKmerReferences():
+  #Yield (database, segment, subtype) labels with reference sequences shipped with Elvira
+  for reference in KMER_REFERENCES:
+    reference_path = os.path.join(ELVIRA_RESOURCES, reference["path"])
+    if reference["format"] == "fasta":
+      for values in readFASTARecords(reference_path, list(indexReferenceFASTAFile(reference_path))):
+        tokens = values["header"].split("_")
+        segment = next((token for token in tokens if token in SEGMENT_MAP.values()), "")
+        subtype = re.match("(H\\d+)(N\\d+)", tokens[0])
+        serotype = ""
+        if subtype and segment in ("HA", "NA"):
+          serotype = subtype.group(1) if segment == "HA" else subtype.group(2)
+        yield (reference["database"], segment, serotype), values["data"]
+    else:
+      lineages = {}
+      with open(os.path.join(ELVIRA_RESOURCES, reference["lineage_map"])) as lf:
+        for line in lf:
+          ids = line.split()
+          if len(ids) == 2:
+            lineages[ids[0].split("|")[3].split(".")[0].upper()] = ids[1]
+
+      accessions = readBlastAccessions(reference_path)
+      for oid, sequence in readBlastNucleotideDB(reference_path):
+        yield (reference["database"], reference["segment"], lineages.get(accessions.get(oid), "")), sequence
+
+def indexReferenceFASTAFile(fasta_file):
+  #Reference FASTA headers are plain names
+  for entry in indexFASTAFile(fasta_file):
+    entry["header"] = entry["header"].split()[0]
+    yield entry
+
+def getSequenceKmers(sequence):
+  #Encode every k-mer with 2 bits per base, k-mers overlapping non ACGT bases are skipped
+  bases = QC_BASE_TABLE[np.frombuffer(sequence, dtype=np.uint8)].astype(np.uint32)
+  if len(bases) < KMER_SIZE:
+    return np.zeros(0, dtype=np.uint32)
+
+  window_count = len(bases) - KMER_SIZE + 1
+  kmers = np.zeros(window_count, dtype=np.uint32)
+  for i in range(KMER_SIZE):
+    kmers = (kmers << 2) | (bases[i:i + window_count] & 3)
+
+  invalid = np.concatenate(([0], np.cumsum(bases > 3)))
+  return kmers[(invalid[KMER_SIZE:] - invalid[:window_count]) == 0]
+
+def buildKmerIndex(index_dir):
+  labels = []
+  pairs = []
+  for label, sequence in loadKmerReferences():
+    if label not in labels:
+      labels.append(label)
+    kmers = np.unique(getSequenceKmers(sequence)).astype(np.uint64)
+    pairs.append(np.unique((kmers << 16) | labels.index(label)))
+
+  #Store sorted k-mers with their label ids so that lookups are binary searches over memory mapped arrays
+  pairs = np.unique(np.concatenate(pairs))
+  temp_dir = tempfile.mkdtemp(prefix=".kmer_index_", dir=os.path.dirname(index_dir))
+  np.save(os.path.join(temp_dir, "kmers.npy"), (pairs >> 16).astype(np.uint32))
+  np.save(os.path.join(temp_dir, "labels.npy"), (pairs & 0xFFFF).astype(np.uint16))
+  with open(os.path.join(temp_dir, "labels.json"), "w") as lf:
+    json.dump({"kmer_size": KMER_SIZE, "references": getKmerReferencesFingerprint(), "labels": labels}, lf)
+  setUmaskPermissions(temp_dir)
+
+  if os.path.isdir(index_dir):
+    shutil.rmtree(index_dir)
+  os.rename(temp_dir, index_dir)
+  print("Built k-mer index with %d k-mers for %d labels in %s" %(len(pairs), len(labels), index_dir))
+
+def getKmerReferencesFingerprint():
+  fingerprint = []
+  for reference in KMER_REFERENCES:
+    reference_path = os.path.join(ELVIRA_RESOURCES, reference["path"])
+    if reference["format"] != "fasta":
+      reference_path += ".nsq"
+    fingerprint.append("%s:%d" %(reference["path"], os.path.getsize(reference_path)))
+
+  return fingerprint
+
+def loadKmerIndex(index_dir):
+  if index_dir not in KMER_INDEXES:
+    with open(os.path.join(index_dir, "labels.json")) as lf:
+      info = json.load(lf)
+    KMER_INDEXES[index_dir] = {"kmers": np.load(os.path.join(index_dir, "kmers.npy"), mmap_mode="r"),
+                               "labels": np.load(os.path.join(index_dir, "labels.npy"), mmap_mode="r"),
+                               "names": [tuple(label) for label in info["labels"]],
+                               "segments": set((label[0], label[1]) for label in info["labels"])}
+
+  return KMER_INDEXES[index_dir]
+
+def isKmerIndexCurrent(index_dir):
+  try:
+    with open(os.path.join(index_dir, "labels.json")) as lf:
+      info = json.load(lf)
+  except (IOError, OSError, ValueError):
+    return False
+
+  return info["kmer_size"] == KMER_SIZE and info["references"] == getKmerReferencesFingerprint()
+
+def classifySequence(index_dir, sequence, database, segment):
+  index = loadKmerIndex(index_dir)
+
+  #Only classify segments with reference sequences, others are left to the VIGOR4 annotation
+  result = {"result": "", "segment": "", "serotype": "", "lineage": "", "message": ""}
+  if (database, segment) not in index["segments"]:
+    return result
+
+  #Find every label sharing a k-mer with the sequence and count votes per label
+  kmers = np.unique(getSequenceKmers(sequence.upper()))
+  starts = np.searchsorted(index["kmers"], kmers, side="left")
+  ends = np.searchsorted(index["kmers"], kmers, side="right")
+  counts = ends - starts
+  if counts.sum() == 0:
+    #Sequences of subtypes without references are left to the VIGOR4 annotation
+    return dict(result, message="WARNING: No reference k-mer matches the sequence, segment and subtype are not classified")
+
+  positions = np.repeat(ends - counts.cumsum(), counts) + np.arange(counts.sum())
+  votes = np.bincount(np.asarray(index["labels"])[positions], minlength=len(index["names"]))
+
+  segment_votes = {}
+  for label_id, count in enumerate(votes):
+    if index["names"][label_id][0] == database:
+      segment_votes[index["names"][label_id][1]] = segment_votes.get(index["names"][label_id][1], 0) + count
+
+  segment, segment_count = max(segment_votes.items(), key=lambda item: item[1])
+  if segment_count < KMER_MIN_VOTES:
+    return dict(result, message="WARNING: Too few reference k-mer matches (%d) to classify the segment and subtype" %(segment_count))
+
+  result["result"] = "VALID"
+  result["segment"] = segment
+
+  subtype_votes = {}
+  for label_id, count in enumerate(votes):
+    if index["names"][label_id][:2] == (database, segment) and index["names"][label_id][2]:
+      subtype_votes[index["names"][label_id][2]] = max(subtype_votes.get(index["names"][label_id][2], 0), count)
+  if subtype_votes:
+    subtype, count = max(subtype_votes.items(), key=lambda item: item[1])
+    runner_up_count = max([other_count for other_subtype, other_count in subtype_votes.items() if other_subtype != subtype] or [0])
+    if count >= KMER_MIN_VOTES and count >= KMER_MIN_SUBTYPE_FRACTION * len(kmers) and count - runner_up_count >= KMER_MIN_SUBTYPE_MARGIN * len(kmers):
+      result[next(reference["subtype"] for reference in KMER_REFERENCES if reference["database"] == database)] = subtype
+
+  return result
+
+def readNormalizationTable(table):
+  #Lines of an Elvira table without comments and empty lines
+  with codecs.open(os.path.join(ELVIRA_DIR, NORMALIZATION_TABLES[table]), "r", "utf-8") as tf:
+    for line in tf:
+      line = line.rstrip("\r\n")
+      if line.strip() and not line.startswith("#"):
+        yield line
+
+def hasNormalizationTables():
+  return all(os.path.exists(os.path.join(ELVIRA_DIR, path)) for path in NORMALIZATION_TABLES.values())
+
+def getNormalizationTablesFingerprint():
+  return ["%s:%d" %(path, os.path.getsize(os.path.join(ELVIRA_DIR, path))) for path in NORMALIZATION_TABLES.values()]
+
+def foldName(name):
+  #Lookup key of a name, case, diacritics, punctuation and spacing are ignored
+  if not isinstance(name, type(u"")):
+    name = name.decode("utf-8")
+  name = u"".join(c for c in unicodedata.normalize("NFKD", name) if not unicodedata.combining(c))
+  return u" ".join(part for part in NAME_SEPARATOR_PATTERN.split(name.lower()) if part)
+
+def toNativeString(value):
+  #csv rows hold utf-8 encoded strings on Python 2 and unicode strings on Python 3
+  return value.encode("utf-8") if str is bytes and isinstance(value, type(u"")) else value
+
+def loadNormalizationNames():
+  #Map folded aliases to INSDC country names and to the host names of the normalized host map.
+  #INSDC names come first, then ISO codes and the names of the ISO tables through their ISO code.
+  countries = OrderedDict()
+  for name in readNormalizationTable("insdc_countries"):
+    countries.setdefault(foldName(name), name.strip())
+  for alias, name in COUNTRY_ALIASES.items():
+    countries.setdefault(foldName(alias), name)
+
+  iso_names = OrderedDict()
+  for line in readNormalizationTable("country_codes"):
+    fields = line.split("\t")
+    countries.setdefault(foldName(fields[0]), fields[0])
+    for code in fields[1:3]:
+      if code:
+        iso_names.setdefault(code, fields[0])
+  for line in readNormalizationTable("insdc_iso_codes"):
+    name, separator, code = line.partition("\t")
+    iso_names.setdefault(code.strip(), name)
+
+  for table in ("iso_country_names", "edited_iso_country_names"):
+    for fields in csv.reader(toNativeString(line) for line in readNormalizationTable(table)):
+      if len(fields) > 2 and fields[1] in iso_names:
+        countries.setdefault(foldName(fields[0]), iso_names[fields[1]])
+        iso_names.setdefault(fields[2], iso_names[fields[1]])
+  for code, name in iso_names.items():
+    countries.setdefault(foldName(code), name)
+
+  hosts = OrderedDict()
+  for line in readNormalizationTable("hosts"):
+    name, separator, category = line.partition("\t")
+    if category:
+      hosts.setdefault(foldName(name), name)
+
+  return {"country": countries, "host": hosts}
+
+def buildNormalizationIndex(index_dir):
+  #Store sorted kind:alias keys with their names so that lookups are binary searches over a memory mapped file
+  names = loadNormalizationNames()
+  records = sorted((("%s:%s" %(kind, alias)).encode("utf-8"), name.encode("utf-8")) for kind, aliases in names.items() for alias, name in aliases.items())
+  offsets = [0]
+  for key, name in records:
+    offsets.append(offsets[-1] + len(key) + 1 + len(name))
+
+  temp_dir = tempfile.mkdtemp(prefix=".normalization_index_", dir=os.path.dirname(index_dir))
+  with open(os.path.join(temp_dir, "names.idx"), "wb") as nf:
+    nf.write(struct.pack(">I", len(records)))
+    nf.write(struct.pack(">%dI" %(len(offsets)), *offsets))
+    for key, name in records:
+      nf.write(key + b"\t" + name)
+  with open(os.path.join(temp_dir, "names.json"), "w") as nf:
+    json.dump({"tables": getNormalizationTablesFingerprint(), "aliases": COUNTRY_ALIASES, "counts": dict((kind, len(aliases)) for kind, aliases in names.items())}, nf)
+  setUmaskPermissions(temp_dir)
+
+  #Jobs sharing the index folder may build it at the same time, a current index left by another job is kept
+  if os.path.isdir(index_dir) and not isNormalizationIndexCurrent(index_dir):
+    stale_dir = tempfile.mkdtemp(prefix=".normalization_index_", dir=os.path.dirname(index_dir))
+    try:
+      os.rename(index_dir, os.path.join(stale_dir, "names"))
+    except OSError:
+      pass
+    shutil.rmtree(stale_dir, ignore_errors=True)
+  try:
+    os.rename(temp_dir, index_dir)
+  except OSError:
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    if not isNormalizationIndexCurrent(index_dir):
+      raise
+    print("Using the normalization index built by another job in %s" %(index_dir))
+    return
+  print("Built normalization index with %d names in %s" %(len(records), index_dir))
+
+def isNormalizationIndexCurrent(index_dir):
+  try:
+    with open(os.path.join(index_dir, "names.json")) as nf:
+      info = json.load(nf)
+  except (IOError, OSError, ValueError):
+    return False
+
+  return info["tables"] == getNormalizationTablesFingerprint() and info.get("aliases") == COUNTRY_ALIASES
+
+def loadNormalizationIndex(index_dir):
+  if index_dir not in NORMALIZATION_INDEXES:
+    with open(os.path.join(index_dir, "names.idx"), "rb") as nf:
+      data = mmap.mmap(nf.fileno(), 0, access=mmap.ACCESS_READ)
+    count = struct.unpack(">I", data[:4])[0]
+    NORMALIZATION_INDEXES[index_dir] = {"data": data, "count": count, "start": 4 * (count + 2), "suggestions": {}}
+
+  return NORMALIZATION_INDEXES[index_dir]
+
+def readNormalizationRecord(index, position):
+  start, end = struct.unpack(">2I", index["data"][4 * (position + 1):4 * (position + 3)])
+  key, separator, name = index["data"][index["start"] + start:index["start"] + end].partition(b"\t")
+  return key, name
+
+def findNormalizationRecord(index, key):
+  #Position of the first record with a key not lower than key
+  low, high = 0, index["count"]
+  while low < high:
+    middle = (low + high) // 2
+    if readNormalizationRecord(index, middle)[0] < key:
+      low = middle + 1
+    else:
+      high = middle
+  return low
+
+def lookupNormalizedName(index, kind, value):
+  key = ("%s:%s" %(kind, foldName(value))).encode("utf-8")
+  position = findNormalizationRecord(index, key)
+  if position < index["count"]:
+    record_key, name = readNormalizationRecord(index, position)
+    if record_key == key:
+      return name.decode("utf-8")
+  return None
+
+def suggestNormalizedNames(index, kind, value):
+  #Close aliases of an unknown value, only computed for values that failed the lookup
+  alias = foldName(value)
+  if (kind, alias) not in index["suggestions"]:
+    prefix = ("%s:" %(kind)).encode("utf-8")
+    position = findNormalizationRecord(index, prefix)
+    aliases = {}
+    while position < index["count"]:
+      key, name = readNormalizationRecord(index, position)
+      if not key.startswith(prefix):
+        break
+      aliases[key[len(prefix):].decode("utf-8")] = name.decode("utf-8")
+      position += 1
+
+    suggestions = []
+    for match in difflib.get_close_matches(alias, list(aliases.keys()), n=NORMALIZATION_MAX_SUGGESTIONS * 2, cutoff=0.75):
+      if aliases[match] not in suggestions:
+        suggestions.append(aliases[match])
+    index["suggestions"][(kind, alias)] = suggestions[:NORMALIZATION_MAX_SUGGESTIONS]
+
+  return index["suggestions"][(kind, alias)]
+
+def formatSuggestions(suggestions):
+  return toNativeString(u", did you mean %s?" %(u", ".join(u"'%s'" %(suggestion) for suggestion in suggestions))) if suggestions else ""
+
+def normalizeMetadataRow(index, row):
+  #Replace Collection Country with its INSDC spelling and check Host against the normalized host map
+  problems = []
+  country = row.get("Collection Country") or ""
+  if country.strip():
+    name, separator, region = country.partition(":")
+    normalized_name = lookupNormalizedName(index, "country", name)
+    if foldName(name) in COUNTRY_MISSING_VALUES:
+      normalized_name = foldName(name)
+    if normalized_name is None:
+      problems.append(("WARNING", "Collection Country '%s' is not an INSDC country%s" %(country, formatSuggestions(suggestNormalizedNames(index, "country", name)))))
+    else:
+      normalized_country = toNativeString(normalized_name) + (": " + region.strip() if region.strip() else "")
+      if normalized_country != country:
+        row["Collection Country"] = normalized_country
+        problems.append(("WARNING", "Collection Country '%s' was normalized to '%s'" %(country, normalized_country)))
+
+  host = row.get("Host") or ""
+  if host.strip() and lookupNormalizedName(index, "host", host) is None:
+    problems.append(("WARNING", "Host '%s' is not in the normalized host list%s" %(host, formatSuggestions(suggestNormalizedNames(index, "host", host)))))
+
+  return problems
+
+def createSubmissionXML(submission_files, sample_identifier, date):
   submission = ET.Element("Submission")
   
   #Create description part
@@ -212,12 +1704,30 @@ def createSubmissionXML(submission_file, sample_identifier, date):
   identifier = ET.SubElement(add_files, "Identifier")
   ET.SubElement(identifier, "SPUID", spuid_namespace="BVBRC").text = "%s.%s" %(date, sample_identifier)
 
-  #Write xml to submission file
+  #Write xml to submission files
   pretty_xml = minidom.parseString(ET.tostring(submission)).toprettyxml(indent = "   ")
-  with open(submission_file, "wb") as sf:
-    sf.write(pretty_xml)
-
-def createSBTFile(sbt_file, metadata, job_data):
+  for submission_file in submission_files:
+    with open(submission_file, "wb") as sf:
+      sf.write(pretty_xml)
+
+def compileSBTTemplate(template_file):
+  #Split the template once into literal text at even and placeholder names at odd positions
+  with open(template_file, "r") as template:
+    return re.split("%([a-z_]+)%", template.read())
+
+def renderSBTTemplate(template_parts, fields):
+  return "".join(part if index % 2 == 0 else fields[part] for index, part in enumerate(template_parts))
+
+def createSBTContent(metadata, job_data):
+  #Samples sharing submitter, publication and BioProject information share the rendered SBT
+  key = tuple(job_data.get(field, "") for field in SBT_JOB_FIELDS) + tuple(metadata.get(field, "") for field in SBT_METADATA_FIELDS)
+  if key not in SBT_CACHE:
+    if len(SBT_CACHE) >= SBT_CACHE_SIZE:
+      SBT_CACHE.clear()
+    SBT_CACHE[key] = renderSBTContent(metadata, job_data)
+  return SBT_CACHE[key]
+
+def renderSBTContent(metadata, job_data):
   first_name = job_data["first_name"]
   last_name = job_data["last_name"]
   email = job_data["email"]
@@ -230,9 +1740,8 @@ def createSBTFile(sbt_file, metadata, job_data):
   postal_code = job_data["postal_code"] if "postal_code" in job_data else ""
   country = job_data["country"] if "country" in job_data else ""
 
-  template = open(SBT_TEMPLATE, "r")
-  sbt_string = template.read()
-  template.close()
+  if not SBT_TEMPLATE_PARTS:
+    SBT_TEMPLATE_PARTS.extend(compileSBTTemplate(SBT_TEMPLATE))
 
   auth_name_template = ("{\n" 
                    "          name name {\n"  
@@ -326,46 +1835,725 @@ def createSBTFile(sbt_file, metadata, job_data):
   else:
     bio_info = ""
 
-  #Write data to sbt file
-  with open(sbt_file, "wb") as sf:
-    sf.write(sbt_string.replace("%affiliation%", affiliation)
-                       .replace("%street%", street)
-                       .replace("%city%", city)
-                       .replace("%state%", state)
-                       .replace("%country%", country)
-                       .replace("%zipcode%", postal_code)
-                       .replace("%cit_authors_names%", cit_auth_names[:-1])
-                       .replace("%bio_info%", bio_info)
-                       .replace("%pub_info%", pub_info.replace(u'\xa0', u' '))
-            )
-
-def createZipFile(submission_folder, is_manual_submission):
-  zf = zipfile.ZipFile(os.path.join(submission_folder, "submission.zip"), "w", zipfile.ZIP_DEFLATED)
-
-  extensions = (".fsa", ".src", ".sbt", ".tbl", ".sqn") if is_manual_submission else (".fsa", ".src", ".sbt")
-  for filename in os.listdir(submission_folder):
-    if filename.endswith(extensions):
-      f = os.path.join(submission_folder, filename)
-
-      #Add file to submission zip file
-      zf.write(f, filename)
-   
-      #Remove file after zipped
-      os.remove(f)
+  #Fill the template, metadata fields are decoded so the content is encoded back to utf-8
+  sbt_content = renderSBTTemplate(SBT_TEMPLATE_PARTS, {"affiliation": affiliation,
+                                                        "street": street,
+                                                        "city": city,
+                                                        "state": state,
+                                                        "country": country,
+                                                        "zipcode": postal_code,
+                                                        "cit_authors_names": cit_auth_names[:-1],
+                                                        "bio_info": bio_info,
+                                                        "pub_info": pub_info.replace(u'\xa0', u' ')})
+  return sbt_content.encode("utf-8") if isinstance(sbt_content, type(u"")) else sbt_content
+
+def linkSBTFile(sbt_dir, sbt_content, sbt_file):
+  #Identical SBT files are written once per job and hard linked into the sample folders
+  shared_file = os.path.join(sbt_dir, hashlib.sha1(sbt_content).hexdigest() + ".sbt")
+  if not os.path.exists(shared_file):
+    writeFileAtomically(shared_file, lambda sf: sf.write(sbt_content), "wb")
+
+  try:
+    os.link(shared_file, sbt_file)
+  except OSError:
+    shutil.copy(shared_file, sbt_file)
+
+  return shared_file
+
+def createZipFile(zip_file, artifacts, files, compression_level):
+  #Write in memory artifacts and files from disk to the archive, files are removed once zipped.
+  #Level 0 stores files, other levels are passed to zlib. zipfile takes a level from Python 3.7 on,
+  #before that it always deflates with the zlib default level.
+  compression = zipfile.ZIP_STORED if compression_level == 0 else zipfile.ZIP_DEFLATED
+  zip_options = {"compresslevel": compression_level} if compression_level > 0 and sys.version_info >= (3, 7) else {}
+  zf = zipfile.ZipFile(zip_file, "w", compression, **zip_options)
+
+  for filename, content in artifacts.items():
+    zf.writestr(filename, content)
+
+  for f in files:
+    zf.write(f, os.path.basename(f))
+    os.remove(f)
 
   zf.close()
 
-if __name__ == "__main__":
-  parser = argparse.ArgumentParser(description="Sequence Submission Script")
-  parser.add_argument("-j", "--jfile", help="json file for job", required=True)
-  parser.add_argument("-o", "--output", help="Output directory. defaults to current directory", required=False, default=".")
+def getSampleFingerprint(row, records, options):
+  #Changes to the metadata, the sequences or the options affecting the results invalidate a completed sample
+  fingerprint = hashlib.sha256(json.dumps([row, options["vigor_mode"], options["segment_classifier"]], sort_keys=True))
+  for fasta in records:
+    fingerprint.update(fasta["header"] + "\n" + fasta["data"] + "\n")
+  return fingerprint.hexdigest()
 
-  args = parser.parse_args()
+def getSampleManifestPath(manifest_dir, sample_identifier):
+  return os.path.join(manifest_dir, sample_identifier + ".json")
+
+def writeSampleManifest(manifest_dir, sample_identifier, manifest):
+  #An interrupted job never leaves a partial manifest
+  writeFileAtomically(getSampleManifestPath(manifest_dir, sample_identifier), lambda mf: json.dump(manifest, mf))
+
+def readSampleManifest(manifest_dir, sample_identifier, fingerprint):
+  #Return the manifest of a completed sample or None if the sample has to be processed again
+  try:
+    with open(getSampleManifestPath(manifest_dir, sample_identifier)) as mf:
+      manifest = json.load(mf)
+  except (IOError, OSError, ValueError):
+    return None
+
+  if manifest.get("fingerprint") != fingerprint:
+    return None
+
+  #A sample is processed again when any of its output files was removed after it completed
+  output_dir = os.path.dirname(manifest_dir)
+  if "files" not in manifest or not all(os.path.isfile(os.path.join(output_dir, f)) for f in manifest["files"]):
+    return None
+
+  return manifest
+
+def listSampleOutputFiles(folders, sample_identifier):
+  #Output files of the sample relative to the output folder
+  output_dir = os.path.dirname(folders["manifests"])
+  files = []
+  for name in ("sequence_validation", "submission", "manual_submission"):
+    for root, dirs, file_names in os.walk(os.path.join(folders[name], sample_identifier)):
+      files.extend(os.path.relpath(os.path.join(root, file_name), output_dir) for file_name in file_names)
+
+  return sorted(files)
+
+def removeSampleOutput(folders, sample_identifier):
+  #Remove leftovers of an incomplete run of the sample
+  for name in ("sequence_validation", "submission", "manual_submission"):
+    sample_dir = os.path.join(folders[name], sample_identifier)
+    if os.path.isdir(sample_dir):
+      shutil.rmtree(sample_dir)
+
+  manifest_file = getSampleManifestPath(folders["manifests"], sample_identifier)
+  if os.path.exists(manifest_file):
+    os.remove(manifest_file)
+
+def getPathDigest(path):
+  #Hash relative file names and contents so that unchanged files and folders are not uploaded again
+  digest = hashlib.sha256()
+  if os.path.isdir(path):
+    files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names)
+  else:
+    files = [path]
+
+  for file_path in files:
+    digest.update(os.path.relpath(file_path, os.path.dirname(path)) + "\0")
+    with open(file_path, "rb") as f:
+      for block in iter(lambda: f.read(1024 * 1024), b""):
+        digest.update(block)
+    digest.update("\0")
+  return digest.hexdigest()
+
+def startUploader(output_dir, upload_folder, workers):
+  #Results are uploaded by a bounded pool of p3-cp commands while samples are still being processed
+  ledger_file = os.path.join(output_dir, UPLOAD_LEDGER_FILE_NAME)
+  ledger = {}
+  if os.path.exists(ledger_file):
+    try:
+      with open(ledger_file) as lf:
+        ledger = json.load(lf)
+    except ValueError:
+      ledger = {}
+
+  return {"output_dir": output_dir,
+          "folder": upload_folder.rstrip("/"),
+          "pool": ThreadPool(workers),
+          "lock": threading.Lock(),
+          "ledger": ledger,
+          "ledger_file": ledger_file,
+          "uploaded": 0,
+          "skipped": 0,
+          "failed": 0}
+
+def createRemoteFolders(uploader, relative_folders):
+  #Parent folders have to exist before sample folders are copied into them, existing folders are not an error
+  for relative_folder in relative_folders:
+    runExternalCommand(["p3-mkdir", "ws:%s/%s" %(uploader["folder"], relative_folder)], "upload", check=False)
+
+def uploadPath(uploader, relative_path):
+  local_path = os.path.join(uploader["output_dir"], relative_path)
+  digest = getPathDigest(local_path)
+  if uploader["ledger"].get(relative_path) == digest:
+    with uploader["lock"]:
+      uploader["skipped"] += 1
+    return
+
+  remote_folder = "/".join([uploader["folder"]] + relative_path.split(os.sep)[:-1])
+  upload_cmd = ["p3-cp", "-f"]
+  for suffix, workspace_type in UPLOAD_SUFFIX_MAP.items():
+    upload_cmd += ["--map-suffix", "%s=%s" %(suffix, workspace_type)]
+  if os.path.isdir(local_path):
+    upload_cmd.append("-r")
+  upload_cmd += [local_path, "ws:" + remote_folder]
+
+  try:
+    runExternalCommand(upload_cmd, "upload", capture=True)
+  except Exception as e:
+    print("Error uploading %s to workspace:\n %s" %(relative_path, e))
+    with uploader["lock"]:
+      uploader["failed"] += 1
+    return
+
+  #Record the upload right away so that a resumed job skips it
+  with uploader["lock"]:
+    uploader["uploaded"] += 1
+    uploader["ledger"][relative_path] = digest
+    writeFileAtomically(uploader["ledger_file"], lambda lf: json.dump(uploader["ledger"], lf))
+
+def queueUpload(uploader, relative_path):
+  return uploader["pool"].apply_async(uploadPath, (uploader, relative_path))
+
+def finishUploader(uploader):
+  uploader["pool"].close()
+  uploader["pool"].join()
+  print("Workspace upload: %d uploaded, %d unchanged, %d failed" %(uploader["uploaded"], uploader["skipped"], uploader["failed"]))
+
+def uploadJobFiles(uploader):
+  #Upload the top level files once they are final and wait for all pending uploads
+  for name in sorted(os.listdir(uploader["output_dir"])):
+    if not name.startswith(".") and os.path.isfile(os.path.join(uploader["output_dir"], name)):
+      queueUpload(uploader, name)
+  finishUploader(uploader)
+
+def startProgress(output_dir, sample_count, resume):
+  #Progress of the job for users and operators, one JSON line per sample event and a status file replaced atomically
+  progress = {"output_dir": output_dir,
+              "file": open(os.path.join(output_dir, PROGRESS_FILE_NAME), "a" if resume else "w"),
+              "lock": threading.Lock(),
+              "start_time": time.time(),
+              "status": OrderedDict([("state", "running"),
+                                     ("samples", sample_count),
+                                     ("completed", 0),
+                                     ("failed", 0),
+                                     ("started", datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))])}
+  writeProgressStatus(progress)
+  return progress
+
+def writeProgressStatus(progress):
+  progress["status"]["updated"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+  progress["status"]["elapsed"] = round(time.time() - progress["start_time"], 3)
+  writeFileAtomically(os.path.join(progress["output_dir"], STATUS_FILE_NAME), lambda sf: json.dump(progress["status"], sf, indent=2))
+
+def getSampleStageTimes(records):
+  #Wall time of the stages of a sample, tool commands are part of their stages
+  stages = OrderedDict()
+  for record in records:
+    if not record["Command"]:
+      stages[record["Stage"]] = round(stages.get(record["Stage"], 0) + record["Wall_Time"], 3)
+  return stages
+
+def reportProgress(progress, sample_identifier, status, stages=None, error=""):
+  #Each record is written with a single flushed write so that readers never see partial lines
+  with progress["lock"]:
+    record = OrderedDict([("time", datetime.now().strftime("%Y-%m-%dT%H:%M:%S")),
+                          ("sample_identifier", sample_identifier),
+                          ("status", status),
+                          ("stages", stages or {}),
+                          ("error", error)])
+    progress["file"].write(json.dumps(record) + "\n")
+    progress["file"].flush()
+    if status in ("completed", "resumed"):
+      progress["status"]["completed"] += 1
+    elif status == "failed":
+      progress["status"]["failed"] += 1
+    writeProgressStatus(progress)
+
+def setProgressCounter(progress, name, value):
+  with progress["lock"]:
+    progress["status"][name] = value
+    writeProgressStatus(progress)
+
+def finishProgress(progress, state):
+  with progress["lock"]:
+    progress["status"]["state"] = state
+    writeProgressStatus(progress)
+    progress["file"].close()
+
+def writeReportParquet(report_file, parquet_file):
+  #Columnar copy of the report for aggregation across jobs, numeric columns are typed and empty values are nulls
+  with open(report_file) as rf:
+    rows = list(csv.DictReader(rf))
+
+  arrays = []
+  for column in SUBMISSION_FILE_HEADER:
+    values = [row[column] for row in rows]
+    if column in REPORT_NUMERIC_COLUMNS:
+      converter = REPORT_NUMERIC_COLUMNS[column]
+      typed_values = []
+      for value in values:
+        try:
+          typed_values.append(converter(value))
+        except ValueError:
+          typed_values.append(None)
+      arrays.append(pa.array(typed_values, type=pa.int64() if converter is int else pa.float64()))
+    else:
+      arrays.append(pa.array([value.decode("utf-8") if isinstance(value, bytes) else value for value in values], type=pa.string()))
+
+  writeFileAtomically(parquet_file, lambda pf: pq.write_table(pa.Table.from_arrays(arrays, names=SUBMISSION_FILE_HEADER), pf), "wb")
+
+def parseShard(value):
+  #Parse i/N command line settings where shards are numbered from 0
+  try:
+    shard_index, shard_count = [int(part) for part in value.split("/")]
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+      raise ValueError()
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected i/N with 0 <= i < N, got %s" %(value))
+  return shard_index, shard_count
+
+def getSampleShard(sample_identifier, shard_count):
+  #Stable across runs and Python versions, unlike hash()
+  return int(hashlib.sha1(sample_identifier).hexdigest(), 16) % shard_count
+
+def getReportSequenceIds(sample_identifier, value):
+  #Report rows are keyed by sample and segment, which differs from sequence ids accepted with a warning
+  return ["%s-%s" %(sample_identifier, fasta["sequence_id"].split("-")[1]) for fasta in value["fasta"]]
+
+def writeShardManifest(output_dir, shard_index, shard_count, sample_info):
+  manifest = {"shard": shard_index,
+              "shards": shard_count,
+              "samples": OrderedDict((sample_identifier, getReportSequenceIds(sample_identifier, value)) for sample_identifier, value in sample_info.items())}
+  writeFileAtomically(os.path.join(output_dir, SHARD_MANIFEST_FILE_NAME), lambda mf: json.dump(manifest, mf, indent=2))
+
+def mergeShards(shard_dirs, output_dir):
+  #Combine the report fragments and sample folders of shard outputs, every sample has to be in exactly one shard
+  manifests = []
+  for shard_dir in shard_dirs:
+    try:
+      with open(os.path.join(shard_dir, SHARD_MANIFEST_FILE_NAME)) as mf:
+        manifests.append(json.load(mf, object_pairs_hook=OrderedDict))
+    except (IOError, ValueError) as e:
+      print("Error reading shard manifest of %s:\n %s" %(shard_dir, e))
+      sys.exit(-1)
+
+  errors = []
+  shard_count = manifests[0]["shards"]
+  shard_indexes = sorted(manifest["shard"] for manifest in manifests)
+  if any(manifest["shards"] != shard_count for manifest in manifests) or shard_indexes != list(range(shard_count)):
+    errors.append("Expected shards 0 to %d exactly once, got %s" %(shard_count - 1, ", ".join("%s/%s" %(manifest["shard"], manifest["shards"]) for manifest in manifests)))
+
+  #Samples of the metadata file are the expected samples
+  sample_info = parseMetadataFile(os.path.join(shard_dirs[0], METADATA_FILE_NAME))
+  sample_shards = {}
+  for shard_dir, manifest in zip(shard_dirs, manifests):
+    for sample_identifier in manifest["samples"]:
+      sample_shards.setdefault(sample_identifier, []).append(shard_dir)
+  for sample_identifier in sample_info:
+    if len(sample_shards.get(sample_identifier, [])) != 1:
+      errors.append("Sample %s is in %d shards" %(sample_identifier, len(sample_shards.get(sample_identifier, []))))
+  for sample_identifier in sample_shards:
+    if sample_identifier not in sample_info:
+      errors.append("Sample %s of shard %s is not in the metadata file" %(sample_identifier, sample_shards[sample_identifier][0]))
+
+  #Every shard has to report exactly the sequences of its samples
+  rows = {}
+  for shard_dir, manifest in zip(shard_dirs, manifests):
+    expected_ids = set(sequence_id for sequence_ids in manifest["samples"].values() for sequence_id in sequence_ids)
+    reported_ids = set()
+    duplicate_ids = set()
+    row_count = 0
+    try:
+      with open(os.path.join(shard_dir, SUBMISSION_REPORT_FILE_NAME)) as rf:
+        for row in csv.DictReader(rf):
+          if row["Unique_Sequence_Identifier"] in reported_ids:
+            duplicate_ids.add(row["Unique_Sequence_Identifier"])
+          reported_ids.add(row["Unique_Sequence_Identifier"])
+          rows[row["Unique_Sequence_Identifier"]] = row
+          row_count += 1
+    except IOError as e:
+      errors.append("Report fragment of shard %s can not be read: %s" %(shard_dir, e))
+      continue
+
+    missing_ids = expected_ids - reported_ids
+    extra_ids = reported_ids - expected_ids
+    if duplicate_ids or missing_ids or extra_ids:
+      errors.append("Report fragment of shard %s has %d rows for %d expected sequences, missing: %s, extra: %s, duplicated: %s" %(shard_dir, row_count, len(expected_ids),
+                    ", ".join(sorted(missing_ids)) or "none", ", ".join(sorted(extra_ids)) or "none", ", ".join(sorted(duplicate_ids)) or "none"))
+
+  if errors:
+    for error in errors:
+      print("ERROR: " + error)
+    print("Merging %d shards failed with %d errors" %(len(shard_dirs), len(errors)))
+    sys.exit(-1)
+
+  if not os.path.exists(output_dir):
+    os.mkdir(output_dir)
+
+  #Write the merged report in metadata order
+  with open(os.path.join(output_dir, SUBMISSION_REPORT_FILE_NAME), "w") as rf:
+    writer = csv.DictWriter(rf, fieldnames=SUBMISSION_FILE_HEADER)
+    writer.writeheader()
+    for sample_identifier in sample_info:
+      manifest = manifests[shard_dirs.index(sample_shards[sample_identifier][0])]
+      for sequence_id in manifest["samples"][sample_identifier]:
+        writer.writerow(rows[sequence_id])
+
+  #Copy sample folders and the job level input files
+  folders = [SEQUENCE_VALIDATION_FOLDER_NAME,
+             os.path.join(GENBANK_SUBMISSION_FOLDER_NAME, SUBMISSION_FOLDER_NAME),
+             os.path.join(GENBANK_SUBMISSION_FOLDER_NAME, MANUAL_SUBMISSION_FOLDER_NAME)]
+  for folder in folders:
+    if not os.path.isdir(os.path.join(output_dir, folder)):
+      os.makedirs(os.path.join(output_dir, folder))
+    for sample_identifier in sample_info:
+      shutil.copytree(os.path.join(sample_shards[sample_identifier][0], folder, sample_identifier), os.path.join(output_dir, folder, sample_identifier))
+
+  for filename in (INPUT_VALIDATION_REPORT_FILE_NAME, METADATA_FILE_NAME, "input.fasta"):
+    shutil.copy(os.path.join(shard_dirs[0], filename), os.path.join(output_dir, filename))
+
+  print("Merged %d samples from %d shards" %(len(sample_info), len(shard_dirs)))
+
+def processSample(sample_identifier, value, folders, job_data, options):
+  rows = []
+  counters = {"cache_hits": 0, "cache_misses": 0}
+  profile_index = len(PROFILE_RECORDS)
+  sample_stage = startProfileStage()
+
+  #Read sample sequences from the indexed input file
+  stage = startProfileStage()
+  value = dict(value, fasta=list(readFASTARecords(options["input_file"], value["fasta"])))
+
+  print("Processing sample " + sample_identifier)
+
+  #Create sample folder for internal review, batch annotation may have created it already
+  sample_dir = os.path.join(folders["sequence_validation"], sample_identifier)
+  if not os.path.isdir(sample_dir):
+    os.mkdir(sample_dir)
+
+  #Keep the output of the external tools of the sample in its own log file
+  setToolLog(os.path.join(sample_dir, sample_identifier + ".log"))
+
+  #Create sample submission folder for genbank
+  sample_submission_dir = os.path.join(folders["submission"], sample_identifier)
+  os.mkdir(sample_submission_dir)
+
+  #Create manual sample submission folder
+  manual_sample_submission_dir = os.path.join(folders["manual_submission"], sample_identifier)
+  os.mkdir(manual_sample_submission_dir)
+
+  #Submission artifacts are built in memory and written to both submission.zip files,
+  #only the files tbl2asn reads are written to the manual submission folder
+  artifacts = OrderedDict()
+
+  segments = []
+  #Create individual fasta file for the sample
+  fasta_file = os.path.join(sample_dir, sample_identifier + ".fasta")
+  fsa_file_ms = os.path.join(manual_sample_submission_dir, sample_identifier + ".fsa")
+  fsa_content = []
+  with open(fasta_file, "w") as ff:
+    for fasta in value["fasta"]:
+      ff.write(">" + fasta["header"] + "\n")
+
+      sequence_id = fasta["sequence_id"]
+      fsa_content.append(">" + sequence_id + "\n")
+
+      #Create individual fasta files for segments
+      segments.append(sequence_id.split("-")[1])
+      segment_file = os.path.join(sample_dir, sequence_id + ".fasta") 
+      with open(segment_file, "w") as sf:
+        sf.write(">" + sequence_id + "\n")
+  
+        #Write data to files
+        ff.write(fasta["data"] + "\n")
+        fsa_content.append(fasta["data"] + "\n")
+        sf.write(fasta["data"])
+  artifacts[sample_identifier + ".fsa"] = "".join(fsa_content)
+  with open(fsa_file_ms, "w") as ffm:
+    ffm.write(artifacts[sample_identifier + ".fsa"])
+  endProfileStage(stage, "fasta_split")
+
+  #Create individual metadata file for the sample
+  stage = startProfileStage()
+  smf = StringIO()
+  writer = csv.DictWriter(smf, delimiter='\t', fieldnames=SRC_FILE_HEADER)
+  writer.writeheader()
+  
+  # Parse date in the correct format
+  date = parseCollectionDate(value["row"]["Collection Date"])
+
+  # Remove serotype from strain name if exists
+  serotype = value["row"]["Subtype"].strip()
+  strain = value["row"]["Strain Name"].strip()
+  if len(serotype) != 0 and strain.endswith("(" + serotype + ")"):
+      strain = strain.replace("(" + serotype + ")", '')
+
+  for fasta in value["fasta"]:
+      writer.writerow({"Sequence_ID": fasta["sequence_id"],
+                       "Organism": value["row"]["Organism"], 
+                       "Strain": strain,
+                       "Country": value["row"]["Collection Country"], 
+                       "Host": value["row"]["Host"], 
+                       "Collection-date": date,
+                       "Isolation-source": value["row"]["Isolation Source"], 
+                       "Serotype": serotype})
+  artifacts[sample_identifier + ".src"] = smf.getvalue()
+
+  #Write metadata file to manual submission folder for tbl2asn
+  with open(os.path.join(manual_sample_submission_dir, sample_identifier + ".src"), "wb") as smf:
+    smf.write(artifacts[sample_identifier + ".src"])
+  endProfileStage(stage, "metadata_split")
+
+  #Validate sample FASTA file with FLAN
+  #print("Running FluValidator for " + fasta_file)
+  #flan_validator_file = os.path.join(sample_dir, sample_identifier + ".flu")
+  #isFLANSuccessful = runFluValidator(fasta_file, flan_validator_file)
+  #print("FluValidator completed for " + fasta_file)
+
+  #Use cached annotations when every sequence of the sample is in the cache
+  stage = startProfileStage()
+  is_annotated = value.get("vigor_annotated", False)
+  cache_dir = options["annotation_cache"]
+  database = DATABASE_MAP.get(value["row"]["Organism"].lower())
+  if cache_dir and not is_annotated and database:
+    cached_results = [(fasta["sequence_id"], lookupAnnotationCache(cache_dir, getSequenceHash(fasta["data"]), database, fasta["sequence_id"])) for fasta in value["fasta"]]
+    if all(result is not None for sequence_id, result in cached_results):
+      writeSampleVIGOR4Results(sample_dir, sample_identifier, cached_results)
+      counters["cache_hits"] += len(cached_results)
+      is_annotated = True
+    else:
+      counters["cache_misses"] += len(cached_results)
+
+  #Annotate sample FASTA file with VIGOR4 unless the batch annotation or the cache already did
+  if is_annotated:
+    isSampleVIGOR4Successful = True
+  else:
+    isSampleVIGOR4Successful = runVIGOR4(fsa_file_ms, value["row"]["Organism"], sample_dir, options["reference_db"])
+
+  #Derive segment results from the sample annotation instead of annotating each segment again
+  if options["vigor_mode"] != "segment" and not is_annotated and isSampleVIGOR4Successful:
+    sequence_ids = [fasta["sequence_id"] for fasta in value["fasta"]]
+    segment_results = splitVIGOR4Output(os.path.join(sample_dir, sample_identifier), sequence_ids)
+    for fasta in value["fasta"]:
+      result = segment_results[fasta["sequence_id"]]
+      writeVIGOR4Result(os.path.join(sample_dir, fasta["sequence_id"]), result)
+      if cache_dir and database:
+        storeAnnotationCache(cache_dir, getSequenceHash(fasta["data"]), database, fasta["sequence_id"], result)
+
+  #Copy tbl file to manual submission folder
+  sample_tbl_file = sample_identifier + ".tbl"
+  shutil.copy(os.path.join(sample_dir, sample_tbl_file), os.path.join(manual_sample_submission_dir, sample_tbl_file)) 
+  endProfileStage(stage, "vigor4")
+
+  #Compute sequence QC metrics for the sample in bulk, internal stops are read from the VIGOR4 cds files
+  stage = startProfileStage()
+  qc_rows = computeSequenceQC(value["fasta"], database, sample_dir)
+  endProfileStage(stage, "qc")
+
+  #Validate all segments of the sample with the FLAN server in one request
+  flan_results = {}
+  if options["segment_classifier"] == "flan":
+    print("Running FluValidator for " + sample_identifier)
+    stage = startProfileStage()
+    flan_results = requestFluValidation(options["flan_server"], [os.path.join(sample_dir, fasta["sequence_id"] + ".fasta") for fasta in value["fasta"]])
+    endProfileStage(stage, "flan")
+
+  #Run VIGOR4 and FLAN for each segment
+  stage = startProfileStage()
+  for index, segment in enumerate(segments):
+    segment_file = os.path.join(sample_dir, "%s-%s.fasta" %(sample_identifier, segment))
+
+    #Run VIGOR4
+    if options["vigor_mode"] != "segment":
+      isVIGOR4Successful = isSampleVIGOR4Successful
+    else:
+      print("SF: " + segment_file)
+      isVIGOR4Successful = runVIGOR4(segment_file, value["row"]["Organism"], sample_dir, options["reference_db"])
+
+    #Check .tbl file for validation
+    vigor_status = getVIGOR4Status(isVIGOR4Successful, os.path.join(sample_dir, "%s-%s.tbl" %(sample_identifier, segment)))
+
+    #Validate FLAN result
+    flan_status = "Error"
+    flan_segment = ""
+    flan_serotype = ""
+    flan_message = ""
+    is_flan_enabled = options["segment_classifier"] != "none"
+    result = None
+    if options["segment_classifier"] == "kmer":
+      #Classify segment and subtype in process in place of FLAN
+      result = classifySequence(options["kmer_index"], value["fasta"][index]["data"], database, SEGMENT_MAP.get(segment))
+    elif options["segment_classifier"] == "flan":
+      result = flan_results.get(value["fasta"][index]["sequence_id"])
+
+    cds_result = parseCDSFile(os.path.join(sample_dir, "%s-%s.cds" %(sample_identifier, segment)))
+    if result is not None and result.get("result") == "":
+      #Unclassified segment, validated on the VIGOR4 annotation alone
+      flan_status = "VALID"
+      flan_segment = cds_result.get("gene", "")
+      flan_message = result.get("message", "")
+    elif result is not None:
+      flan_status = result.get("result", "Error")
+      flan_message = result.get("message", "")
+      flan_segment = result.get("segment", "")
+      flan_serotype = result.get("serotype", "")
+
+      if flan_segment and SEGMENT_MAP.get(segment) != flan_segment:
+        flan_message += "ERROR: Sequence segment id (%s) doesn't match with flu annotation segment result (%s)" %(segment, flan_segment) 
+        flan_status = "Failed"
+
+    segment_result = flan_segment if flan_segment == cds_result.get("gene", "") else "VIGOR:%s, FLAN:%s" %(cds_result.get("gene", ""), flan_segment)
+    status_result = flan_status if flan_status == "VALID" and vigor_status == "Processed" else "VIGOR:%s, FLAN:%s" %(vigor_status, flan_status)
+    if is_flan_enabled and len(cds_result) > 0:
+      row = {"Unique_Sequence_Identifier": "%s-%s" %(sample_identifier, segment),
+             "Segment": segment_result,
+             "Serotype": flan_serotype,
+             "Status": status_result,
+             "Messages": flan_message.replace("\n", ", ")}
+    else:
+      row = {"Unique_Sequence_Identifier": "%s-%s" %(sample_identifier, segment),
+             "Segment": "VIGOR: , FLAN:%s" %(flan_segment),
+             "Serotype": flan_serotype,
+             "Status": "VIGOR:ERROR, FLAN:%s" %(flan_status),
+             "Messages": flan_message.replace("\n", ", ")}
+
+    #Add sequence QC metrics
+    row.update(qc_rows[index])
+    rows.append(row)
+  endProfileStage(stage, "segment_validation")
+
+  #Create template file with authour information
+  stage = startProfileStage()
+  artifacts[sample_identifier + ".sbt"] = createSBTContent(value["row"], job_data)
+
+  #Link template file to manual submission folder for tbl2asn
+  sbt_file_ms = os.path.join(manual_sample_submission_dir, sample_identifier + ".sbt")
+  sbt_file = linkSBTFile(folders["sbt"], artifacts[sample_identifier + ".sbt"], sbt_file_ms)
+  endProfileStage(stage, "sbt")
+
+  #Mark the sample as completed with the rows needed to rebuild the report on resume
+  manifest = {"sample_identifier": sample_identifier,
+              "fingerprint": getSampleFingerprint(value["row"], value["fasta"], options),
+              "rows": rows,
+              "counters": counters}
+
+  #In batch mode tbl2asn runs over the staged files of many samples and the parent packages the sample afterwards
+  if options["tbl2asn_mode"] == "batch":
+    endProfileStage(sample_stage, "sample")
+    setToolLog(None)
+    return {"rows": rows, "counters": counters, "profile": collectProfileRecords(profile_index, sample_identifier),
+            "tbl2asn": {"sbt_file": sbt_file, "manifest": manifest}}
+
+  #Create sqn file for manual submission
+  stage = startProfileStage()
+  runTbl2asn(sample_identifier, manual_sample_submission_dir)
+  endProfileStage(stage, "tbl2asn")
+
+  finishSample(sample_identifier, folders, options, manifest, artifacts)
+  endProfileStage(sample_stage, "sample")
+  setToolLog(None)
+
+  return {"rows": rows, "counters": counters, "profile": collectProfileRecords(profile_index, sample_identifier)}
+
+def runTbl2asn(sample_identifier, manual_sample_submission_dir):
+  try:
+    #Run tbl2asn inside the manual submission folder without changing the working directory of the process.
+    #The exit code is ignored as tbl2asn reports validation issues through the .val file.
+    tbl2asn_cmd = ["tbl2asn", "-i", sample_identifier + ".fsa", "-t", sample_identifier + ".sbt", "-o", sample_identifier + ".sqn", "-V", "bvg", "-a", "d", "-X", "C"]
+    runExternalCommand(tbl2asn_cmd, "tbl2asn", cwd=manual_sample_submission_dir, check=False)
+    os.remove(os.path.join(manual_sample_submission_dir, sample_identifier + ".gbf"))
+    os.remove(os.path.join(manual_sample_submission_dir, sample_identifier + ".t2g"))
+    os.remove(os.path.join(manual_sample_submission_dir, sample_identifier + ".val"))
+  except Exception as e:
+    print("Error creating sqn file:\n %s" %(e))
+    sys.exit(-1)
+
+def runTbl2asnBatch(sample_identifiers, sbt_file, folders):
+  #Stage the tbl2asn inputs of samples sharing an SBT file in one folder and run tbl2asn over the whole folder with -p
+  stage_dir = tempfile.mkdtemp(prefix="tbl2asn_", dir=folders["tbl2asn"])
+  for sample_identifier in sample_identifiers:
+    manual_sample_submission_dir = os.path.join(folders["manual_submission"], sample_identifier)
+    for extension in (".fsa", ".tbl", ".src"):
+      source_file = os.path.join(manual_sample_submission_dir, sample_identifier + extension)
+      if not os.path.exists(source_file):
+        continue
+      try:
+        os.link(source_file, os.path.join(stage_dir, sample_identifier + extension))
+      except OSError:
+        shutil.copy(source_file, os.path.join(stage_dir, sample_identifier + extension))
+
+  #The exit code is ignored as in sample mode, samples without a sqn file are run again on their own
+  tbl2asn_cmd = ["tbl2asn", "-p", stage_dir, "-t", sbt_file, "-V", "bvg", "-a", "d", "-X", "C"]
+  try:
+    runExternalCommand(tbl2asn_cmd, "tbl2asn", check=False)
+  except Exception as e:
+    print("Error running tbl2asn over %d samples:\n %s" %(len(sample_identifiers), e))
+
+  for sample_identifier in sample_identifiers:
+    manual_sample_submission_dir = os.path.join(folders["manual_submission"], sample_identifier)
+    sqn_file = os.path.join(stage_dir, sample_identifier + ".sqn")
+    if os.path.exists(sqn_file):
+      os.rename(sqn_file, os.path.join(manual_sample_submission_dir, sample_identifier + ".sqn"))
+    else:
+      print("tbl2asn batch did not create a sqn file for sample %s, running it on its own" %(sample_identifier))
+      runTbl2asn(sample_identifier, manual_sample_submission_dir)
+
+  shutil.rmtree(stage_dir, ignore_errors=True)
+
+def runTbl2asnBatchTask(task):
+  #Run a tbl2asn batch and package its samples in a thread of the parent, SystemExit is converted as in processSampleTask
+  sample_identifiers, sbt_file, manifests, folders, options = task
+  try:
+    stage = startProfileStage()
+    runTbl2asnBatch(sample_identifiers, sbt_file, folders)
+    endProfileStage(stage, "tbl2asn_batch")
+    for sample_identifier in sample_identifiers:
+      finishSample(sample_identifier, folders, options, manifests[sample_identifier])
+  except SystemExit:
+    raise RuntimeError("tbl2asn batch of samples %s failed" %(", ".join(sample_identifiers)))
+  return sample_identifiers
+
+def finishSample(sample_identifier, folders, options, manifest, artifacts=None):
+  #Package the sample once its sqn file exists, artifacts of batched samples are read back from the manual submission folder
+  sample_submission_dir = os.path.join(folders["submission"], sample_identifier)
+  manual_sample_submission_dir = os.path.join(folders["manual_submission"], sample_identifier)
+  if artifacts is None:
+    artifacts = OrderedDict()
+    for extension in (".fsa", ".src", ".sbt"):
+      with open(os.path.join(manual_sample_submission_dir, sample_identifier + extension), "rb") as af:
+        artifacts[sample_identifier + extension] = af.read()
+
+  #Create submission.zip files
+  stage = startProfileStage()
+  createZipFile(os.path.join(sample_submission_dir, "submission.zip"), artifacts, [], options["zip_compression_level"])
+  for filename in artifacts:
+    os.remove(os.path.join(manual_sample_submission_dir, filename))
+  tbl2asn_files = [os.path.join(manual_sample_submission_dir, sample_identifier + extension) for extension in (".tbl", ".sqn")]
+  createZipFile(os.path.join(manual_sample_submission_dir, "submission.zip"), artifacts, [f for f in tbl2asn_files if os.path.exists(f)], options["zip_compression_level"])
+  endProfileStage(stage, "zip", sample_identifier)
+
+  #Create submission.xml files
+  stage = startProfileStage()
+  submission_date = datetime.today().strftime('%Y-%m-%d')
+  createSubmissionXML([os.path.join(sample_submission_dir, "submission.xml"), os.path.join(manual_sample_submission_dir, "submission.xml")], sample_identifier, submission_date)
+  endProfileStage(stage, "xml", sample_identifier)
+
+  #Create submit.ready files
+  with open(os.path.join(sample_submission_dir, "submit.ready"), "w") as sr:
+    pass
+  with open(os.path.join(manual_sample_submission_dir, "submit.ready"), "w") as sr:
+    pass
+
+  manifest["files"] = listSampleOutputFiles(folders, sample_identifier)
+  writeSampleManifest(folders["manifests"], sample_identifier, manifest)
+
+def processSampleTask(task):
+  #Run the sample pipeline in a worker process. SystemExit is converted into an exception
+  #so that a failing sample is reported to the parent instead of silently killing the worker.
+  try:
+    return processSample(*task)
+  except SystemExit:
+    raise RuntimeError("Processing sample %s failed" %(task[0]))
+
+def runJob(args, job_file, output_dir):
+  #Run one submission job into output_dir with the options of the command line
+  job_stage = startProfileStage()
 
   #Load job data
   job_data = None
   try:
-    with open(args.jfile, "r") as j:
+    with open(job_file, "r") as j:
       job_data = json.load(j)
   except Exception as e:
     print("Error in opening job file:\n %s" %(e))
@@ -377,46 +2565,97 @@ if __name__ == "__main__":
   print(job_data)
 
   #Setup output directory
-  output_dir = args.output
-  output_dir = os.path.abspath(output_dir)
   if not os.path.exists(output_dir):
     os.mkdir(output_dir)
-  os.chdir(output_dir)
 
   output_file = os.path.join(output_dir, job_data["output_file"] + ".txt")
 
+  #Define metadata file
+  metadata_file = os.path.join(output_dir, METADATA_FILE_NAME)
+  #Fetch metadata file from workspace while the input file is created
+  metadata_errors = []
+  def fetchMetadataFile():
+    try:
+      fetch_metadata_cmd = ["p3-cp", "ws:%s" %(job_data["metadata"]), metadata_file]
+      runExternalCommand(fetch_metadata_cmd, "metadata_fetch")
+    except Exception as e:
+      metadata_errors.append(e)
+  metadata_thread = threading.Thread(target=fetchMetadataFile)
+  metadata_thread.start()
+
   #Create input file
-  input_file = createFASTAFile(output_dir, job_data)
+  stage = startProfileStage()
+  input_file = createFASTAFile(output_dir, job_data, {"url": args.data_api, "batch_size": args.data_api_batch_size, "workers": args.data_api_workers})
+  endProfileStage(stage, "fasta_fetch")
+  metadata_thread.join()
 
-  if os.path.getsize(input_file) == 0:
-    print("Input fasta file is empty")
+  if metadata_errors:
+    print("Error copying metadata file from workspace:\n %s" %(metadata_errors[0]))
     sys.exit(-1)
 
-  #Define metadata file
-  metadata_file = os.path.join(output_dir, METADATA_FILE_NAME)
-  #Fetch input file from workspace
-  try:
-    fetch_metadata_cmd = ["p3-cp", "ws:%s" %(job_data["metadata"]), metadata_file]
-    subprocess.check_call(fetch_metadata_cmd, shell=False)
-  except Exception as e:
-    print("Error copying metadata file from workspace:\n %s" %(e))
+  if os.path.getsize(input_file) == 0:
+    print("Input fasta file is empty")
     sys.exit(-1)
 
   if os.path.getsize(metadata_file) == 0:
     print("Metadata file is empty")
     sys.exit(-1)
 
+  #Build the normalization index once before the metadata is normalized with it
+  normalization_index = None
+  if args.normalize_metadata:
+    if hasNormalizationTables():
+      index_dir = os.path.abspath(args.normalization_index)
+      if not isNormalizationIndexCurrent(index_dir):
+        stage = startProfileStage()
+        buildNormalizationIndex(index_dir)
+        endProfileStage(stage, "normalization_index")
+      normalization_index = loadNormalizationIndex(index_dir)
+    else:
+      print("Normalization tables are missing in %s, Collection Country and Host are not normalized" %(ELVIRA_DIR))
+
   #Read metadata file
-  sample_info = parseMetadataFile(metadata_file)
-
-  #Read fasta file
-  with open(input_file) as fasta_data:
-    for values in parseFASTAFile(fasta_data):
-      sample_id = values["sample_id"]
-      if sample_id in sample_info.keys():
-        sample_info[sample_id]["fasta"].append(values) 
-      else:
-        print("Sequence id %s does not exist in the metadata. Passing.\n" %(sample_id))
+  stage = startProfileStage()
+  sample_info = parseMetadataFile(metadata_file, normalization_index)
+  metadata_header = next(iter(sample_info.values()))["header"] if sample_info else None
+  endProfileStage(stage, "metadata_parse")
+
+  #Index fasta file, sequences are read when their sample is processed
+  stage = startProfileStage()
+  unmatched_entries = []
+  for values in indexFASTAFile(input_file):
+    sample_id = values["sample_id"]
+    if sample_id in sample_info:
+      sample_info[sample_id]["fasta"].append(values)
+    else:
+      unmatched_entries.append(values)
+  endProfileStage(stage, "fasta_index")
+
+  #Validate all inputs before running any annotation
+  errors, warnings = validateSubmission(sample_info, unmatched_entries, metadata_header)
+  writeInputValidationReport(os.path.join(output_dir, INPUT_VALIDATION_REPORT_FILE_NAME), errors, warnings)
+  if errors:
+    print("Input validation failed with %d errors and %d warnings" %(len(errors), len(warnings)))
+    #The validation report and a failed status tell the user why the job stopped
+    finishProgress(startProgress(output_dir, len(sample_info), False), "failed")
+    if args.upload_folder:
+      uploadJobFiles(startUploader(output_dir, args.upload_folder, args.upload_workers))
+    sys.exit(-1)
+  print("Input validation completed with %d warnings" %(len(warnings)))
+
+  if args.validate_only:
+    return
+
+  #Keep the samples of the shard only, inputs are validated as a whole so that all shards agree
+  if args.shard:
+    shard_index, shard_count = args.shard
+    sample_info = OrderedDict((sample_identifier, value) for sample_identifier, value in sample_info.items() if getSampleShard(sample_identifier, shard_count) == shard_index)
+    writeShardManifest(output_dir, shard_index, shard_count, sample_info)
+    print("Shard %d/%d has %d samples" %(shard_index, shard_count, len(sample_info)))
+
+  if args.report_parquet and pa is None:
+    print("pyarrow is required for the Parquet report")
+    sys.exit(-1)
 
   #Create submission report file
   submission_report_file_path = os.path.join(output_dir, SUBMISSION_REPORT_FILE_NAME)
@@ -426,223 +2665,388 @@ if __name__ == "__main__":
 
   #Create sequence validation folder for initial validation process
   sequence_validation_dir = os.path.join(output_dir, SEQUENCE_VALIDATION_FOLDER_NAME)
-  os.mkdir(sequence_validation_dir)
 
   #Create genbank submission folder 
   genbank_submission_dir = os.path.join(output_dir, GENBANK_SUBMISSION_FOLDER_NAME) 
-  os.mkdir(genbank_submission_dir)
 
   #Create submission folder
   submission_dir = os.path.join(genbank_submission_dir, SUBMISSION_FOLDER_NAME)
-  os.mkdir(submission_dir) 
 
   #Create manual submission folder
   manual_submission_dir = os.path.join(genbank_submission_dir, MANUAL_SUBMISSION_FOLDER_NAME)
-  os.mkdir(manual_submission_dir)
+
+  #Create sample manifest folder, folders of a previous run into the same output directory are reused
+  manifest_dir = os.path.join(output_dir, SAMPLE_MANIFEST_FOLDER_NAME)
+  sbt_dir = os.path.join(output_dir, SBT_FOLDER_NAME)
+  tbl2asn_dir = os.path.join(output_dir, TBL2ASN_FOLDER_NAME)
+  for folder in (sequence_validation_dir, genbank_submission_dir, submission_dir, manual_submission_dir, manifest_dir, sbt_dir, tbl2asn_dir):
+    if not os.path.isdir(folder):
+      os.mkdir(folder)
 
   #Process sample submissions
+  folders = {"sequence_validation": sequence_validation_dir,
+             "submission": submission_dir,
+             "manual_submission": manual_submission_dir,
+             "manifests": manifest_dir,
+             "sbt": sbt_dir,
+             "tbl2asn": tbl2asn_dir}
+  options = {"vigor_mode": args.vigor_mode,
+             "vigor_batch_size": args.vigor_batch_size,
+             "workers": args.workers,
+             "input_file": input_file,
+             "tbl2asn_mode": args.tbl2asn_mode,
+             "zip_compression_level": args.zip_compression_level,
+             "segment_classifier": args.segment_classifier,
+             "kmer_index": os.path.abspath(args.kmer_index),
+             "annotation_cache": os.path.abspath(args.annotation_cache) if args.annotation_cache else None,
+             "reference_db": None}
+  counters = {"cache_hits": 0, "cache_misses": 0, "annotations_saved": 0}
+
+  #Segment mode annotates every segment on its own and does not use the cache
+  if options["annotation_cache"] and args.vigor_mode == "segment":
+    print("The annotation cache is only used by the sample and batch VIGOR4 modes, it is ignored in segment mode")
+    options["annotation_cache"] = None
+
+  #Find samples completed by a previous run, everything else is processed from scratch
+  completed_samples = {}
+  pending_samples = OrderedDict()
   for sample_identifier, value in sample_info.items():
-    print("Processing sample " + sample_identifier)
+    manifest = None
+    if args.resume:
+      fingerprint = getSampleFingerprint(value["row"], readFASTARecords(input_file, value["fasta"]), options)
+      manifest = readSampleManifest(manifest_dir, sample_identifier, fingerprint)
 
-    #Create sample folder for internal review
-    sample_dir = os.path.join(sequence_validation_dir, sample_identifier) 
-    os.mkdir(sample_dir)
+    if manifest is not None:
+      completed_samples[sample_identifier] = manifest
+    else:
+      removeSampleOutput(folders, sample_identifier)
+      pending_samples[sample_identifier] = value
+  if args.resume:
+    print("Resuming job with %d completed and %d remaining samples" %(len(completed_samples), len(pending_samples)))
+
+  #Stage the reference databases of the remaining samples before any annotation runs
+  if args.stage_reference_db and pending_samples:
+    if os.path.isdir(VIGOR_REF_DB):
+      stage = startProfileStage()
+      reference_db = os.path.abspath(args.reference_db_dir)
+      if not os.path.isdir(reference_db):
+        os.makedirs(reference_db)
+      try:
+        staged = stageReferenceDatabases(set(DATABASE_MAP[value["row"]["Organism"].strip().lower()] for value in pending_samples.values()), reference_db)
+      except (IOError, OSError) as e:
+        print("Error staging reference databases:\n %s" %(e))
+        sys.exit(-1)
+      options["reference_db"] = reference_db
+      endProfileStage(stage, "reference_db_stage")
+      print("Staged reference databases in %s: %d files copied, %d verified in %.1f seconds" %(reference_db, staged["copied"], staged["verified"], PROFILE_RECORDS[-1]["Wall_Time"]))
+    else:
+      print("Reference databases not found in %s, VIGOR4 uses its configured databases" %(VIGOR_REF_DB))
 
-    #Create sample submission folder for genbank
-    sample_submission_dir = os.path.join(submission_dir, sample_identifier)
-    os.mkdir(sample_submission_dir)
-
-    #Create manual sample submission folder
-    manual_sample_submission_dir = os.path.join(manual_submission_dir, sample_identifier)
-    os.mkdir(manual_sample_submission_dir)
-
-    #Change working directory to sample submission folder
-    os.chdir(sample_dir)
-
-    segments = []
-    #Create individual fasta file for the sample
-    fasta_file = os.path.join(sample_dir, sample_identifier + ".fasta")
-    fsa_file_ms = os.path.join(manual_sample_submission_dir, sample_identifier + ".fsa")
-    with open(fasta_file, "w") as ff, open(fsa_file_ms, "w") as ffm:
-      for fasta in value["fasta"]:
-        ff.write(">" + fasta["header"] + "\n")
-
-        sequence_id = fasta["sequence_id"]
-        ffm.write(">" + sequence_id + "\n")
-
-        #Create individual fasta files for segments
-        segments.append(sequence_id.split("-")[1])
-        segment_file = os.path.join(sample_dir, sequence_id + ".fasta") 
-        with open(segment_file, "w") as sf:
-          sf.write(">" + sequence_id + "\n")
-    
-          #Write data to files
-          ff.write(fasta["data"] + "\n")
-          ffm.write(fasta["data"] + "\n")
-          sf.write(fasta["data"])
-
-    #Copy fsa file to genbank folder
-    shutil.copy(fsa_file_ms, os.path.join(sample_submission_dir, sample_identifier + ".fsa"))
-
-    #Create individual metadata file for the sample
-    sample_metadata_file = os.path.join(sample_submission_dir, sample_identifier + ".src")
-    with open(sample_metadata_file, "wb") as smf:
-      writer = csv.DictWriter(smf, delimiter='\t', fieldnames=SRC_FILE_HEADER)
-      writer.writeheader()
-      
-      # Parse date in the correct format
-      date = value["row"]["Collection Date"]
-      dashCount = date.count('-')
-      if dashCount == 2:
-          year = date.rsplit('-', 1)[1];
-          if len(year) == 2:
-              date = datetime.strptime(date, '%d-%b-%y').strftime('%d-%b-%Y')
-          else:
-              date = datetime.strptime(date, '%d-%b-%Y').strftime('%d-%b-%Y')
-      elif dashCount == 1:
-          date = datetime.strptime(date, '%b-%y').strftime('%b-%Y')
-      elif dashCount == 0 and len(date) == 2 and date != 'U':
-          date = datetime.strptime(date, '%y').strftime('%Y')
-
-      # Remove serotype from strain name if exists
-      serotype = value["row"]["Subtype"].strip()
-      strain = value["row"]["Strain Name"].strip()
-      if len(serotype) != 0 and strain.endswith("(" + serotype + ")"):
-          strain = strain.replace("(" + serotype + ")", '')
-
-      for fasta in value["fasta"]:
-          writer.writerow({"Sequence_ID": fasta["sequence_id"],
-                           "Organism": value["row"]["Organism"], 
-                           "Strain": strain,
-                           "Country": value["row"]["Collection Country"], 
-                           "Host": value["row"]["Host"], 
-                           "Collection-date": date,
-                           "Isolation-source": value["row"]["Isolation Source"], 
-                           "Serotype": serotype})
-
-    #Copy metadata file to manual submission folder
-    shutil.copy(sample_metadata_file, os.path.join(manual_sample_submission_dir, sample_identifier + ".src"))
-
-    #Validate sample FASTA file with FLAN
-    #print("Running FluValidator for " + fasta_file)
-    #flan_validator_file = os.path.join(sample_dir, sample_identifier + ".flu")
-    #isFLANSuccessful = runFluValidator(fasta_file, flan_validator_file)
-    #print("FluValidator completed for " + fasta_file)
-
-    #Annotate sample FASTA file with VIGOR4
-    runVIGOR4(fsa_file_ms, value["row"]["Organism"])
-
-    #Copy tbl file to manual submission folder
-    sample_tbl_file = sample_identifier + ".tbl"
-    shutil.copy(os.path.join(sample_dir, sample_tbl_file), os.path.join(manual_sample_submission_dir, sample_tbl_file)) 
-
-    #Run VIGOR4 and FLAN for each segment
-    for segment in segments:
-      segment_file = os.path.join(sample_dir, "%s-%s.fasta" %(sample_identifier, segment))
-
-      #Run VIGOR4
-      print("SF: " + segment_file)
-      isVIGOR4Successful = runVIGOR4(segment_file, value["row"]["Organism"]) 
-
-      vigor_status = "Failed"
-      if isVIGOR4Successful:
-        #Check .tbl file for validation
-        tbl_file = os.path.join(sample_dir, "%s-%s.tbl" %(sample_identifier, segment))
-        if os.path.isfile(tbl_file):
-          if  os.path.getsize(tbl_file) > 0:
-            vigor_status = "Processed"
-          else: 
-            vigor_status = "No Annotation"
-        else:
-          vigor_status = "Error"
-
-      #Run FLAN
-      #print("Running FluValidator for " + segment_file)
-      #flan_output_basename = runFluValidatorPerSegment(segment_file)
-      #print("FluValidator completed for " + segment_file)
-
-      #FLAN output files
-      #flan_tbl_file = os.path.join(sample_dir, flan_output_basename + ".tbl")
-      #flan_report_file = os.path.join(sample_dir, flan_output_basename + ".report")
-
-      #Validate FLAN result
-      flan_status = "Error"
-      flan_segment = ""
-      flan_serotype = ""
-      flan_message = ""
-      is_flan_enabled = False
-      if is_flan_enabled and os.path.isfile(flan_tbl_file) and os.path.isfile(flan_report_file):
-        #Parse FLAN result for validation
-        result = parseFluValidatorPerSegmentResult(flan_report_file)
-        flan_status = result["result"]
-        flan_message = result["message"]
-        flan_segment = result["segment"]
-        flan_serotype = result["serotype"]
-
-        fasta_segment = os.path.splitext(result["fasta_name"])[0].split("-")[1]
-        if SEGMENT_MAP[fasta_segment] != result["segment"]:
-          flan_message += "ERROR: Sequence segment id (%s) doesn't match with flu annotation segment result (%s)" %(fasta_segment, result["segment"]) 
-          flan_status = "Failed"
-
-      cds_result = parseCDSFile(os.path.join(sample_dir, "%s-%s.cds" %(sample_identifier, segment)))  
-      segment_result = flan_segment if flan_segment == cds_result.get("gene", "") else "VIGOR:%s, FLAN:%s" %(cds_result.get("gene", ""), flan_segment)
-      status_result = flan_status if flan_status == "VALID" and vigor_status == "Processed" else "VIGOR:%s, FLAN:%s" %(vigor_status, flan_status)
-      if is_flan_enabled and len(cds_result) > 0:
-        submission_report_writer.writerow({"Unique_Sequence_Identifier": "%s-%s" %(sample_identifier, segment),
-                                           "Segment": segment_result,
-                                           "Serotype": flan_serotype,
-                                           "Status": status_result,
-                                           "Messages": flan_message.replace("\n", ", ")})
+  #Compile the SBT template once, worker processes inherit it
+  if not SBT_TEMPLATE_PARTS:
+    SBT_TEMPLATE_PARTS.extend(compileSBTTemplate(SBT_TEMPLATE))
+
+  #Build the k-mer index once before workers memory map it
+  if args.segment_classifier == "kmer":
+    if np is None:
+      print("NumPy is required for the k-mer segment classifier")
+      sys.exit(-1)
+    if not isKmerIndexCurrent(options["kmer_index"]):
+      stage = startProfileStage()
+      buildKmerIndex(options["kmer_index"])
+      endProfileStage(stage, "kmer_index")
+
+  #Start the FLAN server before the workers so that they all share it
+  flan_server = None
+  if args.segment_classifier == "flan":
+    flan_server = startFluValidatorServer(args.flan_batch_size, args.flan_batch_wait)
+    options["flan_server"] = dict((key, flan_server[key]) for key in ("address", "authkey"))
+
+  pool = None
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers, initializer=initToolScheduler, initargs=(dict(TOOL_SEMAPHORES), dict(TOOL_TIMEOUTS)))
+
+  #Upload threads are started after the worker processes are forked
+  uploader = None
+  if args.upload_folder:
+    uploader = startUploader(output_dir, args.upload_folder, args.upload_workers)
+    createRemoteFolders(uploader, [os.path.relpath(folder, output_dir) for folder in (sequence_validation_dir, genbank_submission_dir, submission_dir, manual_submission_dir)])
+
+  #tbl2asn batches run in threads of the parent while the workers process the next samples
+  tbl2asn_pool = None
+  tbl2asn_batches = OrderedDict()
+  tbl2asn_results = []
+  def finishSamples(sample_identifiers):
+    for sample_identifier in sample_identifiers:
+      reportProgress(progress, sample_identifier, "completed")
+    uploadSamples(sample_identifiers)
+  def uploadSamples(sample_identifiers):
+    if uploader is not None:
+      for sample_identifier in sample_identifiers:
+        for folder in (sequence_validation_dir, submission_dir, manual_submission_dir):
+          queueUpload(uploader, os.path.relpath(os.path.join(folder, sample_identifier), output_dir))
+  progress_uploads = []
+  def uploadProgressFiles():
+    #Skipped while the previous copies are still uploading so that the same file is never copied twice at once
+    if uploader is not None and all(upload.ready() for upload in progress_uploads):
+      progress_uploads[:] = [queueUpload(uploader, name) for name in (STATUS_FILE_NAME, PROGRESS_FILE_NAME, SUBMISSION_REPORT_FILE_NAME)]
+  def queueTbl2asnBatch(sbt_file):
+    batch = tbl2asn_batches.pop(sbt_file)
+    task = (list(batch.keys()), sbt_file, batch, folders, options)
+    tbl2asn_results.append(tbl2asn_pool.apply_async(runTbl2asnBatchTask, (task,), callback=finishSamples))
+  if args.tbl2asn_mode == "batch":
+    tbl2asn_pool = ThreadPool(args.workers)
+
+  #Annotate sequences of all samples in chunks before processing samples
+  if args.vigor_mode == "batch":
+    stage = startProfileStage()
+    batch_counters = runVIGOR4Batch(pending_samples, sequence_validation_dir, options, pool)
+    endProfileStage(stage, "vigor4_batch")
+    for name, count in batch_counters.items():
+      counters[name] += count
+
+  progress = startProgress(output_dir, len(sample_info), args.resume)
+  if args.vigor_mode == "batch":
+    #Duplicate sequences that the batch did not annotate again
+    setProgressCounter(progress, "annotations_saved", counters["annotations_saved"])
+
+  tasks = ((sample_identifier, value, folders, job_data, options) for sample_identifier, value in pending_samples.items())
+  if pool is not None:
+    results = pool.imap(processSampleTask, tasks)
+  else:
+    results = (processSample(*task) for task in tasks)
+
+  #Results are returned in sample order so the report is deterministic, completed samples are reported from their manifests.
+  #The report is flushed after every sample so that it can be followed while the job runs.
+  current_sample = ""
+  try:
+    for sample_number, sample_identifier in enumerate(sample_info, 1):
+      current_sample = sample_identifier
+      if sample_identifier in completed_samples:
+        for row in completed_samples[sample_identifier]["rows"]:
+          #Manifest strings are loaded as unicode, the report is written with utf-8 encoded strings
+          submission_report_writer.writerow(dict((key, value.encode("utf-8") if isinstance(value, type(u"")) else value) for key, value in row.items()))
+        submission_report_file.flush()
+        reportProgress(progress, sample_identifier, "resumed")
+        uploadSamples([sample_identifier])
       else:
-        submission_report_writer.writerow({"Unique_Sequence_Identifier": "%s-%s" %(sample_identifier, segment),
-                                           "Segment": "VIGOR: , FLAN:%s" %(flan_segment),
-                                           "Serotype": flan_serotype,
-                                           "Status": "VIGOR:ERROR, FLAN:%s" %(flan_status),
-                                           "Messages": flan_message.replace("\n", ", ")})
+        result = next(results)
+        for row in result["rows"]:
+          submission_report_writer.writerow(row)
+        submission_report_file.flush()
+        for name, count in result["counters"].items():
+          counters[name] += count
+        PROFILE_RECORDS.extend(result["profile"])
+
+        #Samples sharing an SBT file are packaged once their tbl2asn batch is complete
+        if "tbl2asn" in result:
+          reportProgress(progress, sample_identifier, "packaging", getSampleStageTimes(result["profile"]))
+          sbt_file = result["tbl2asn"]["sbt_file"]
+          tbl2asn_batches.setdefault(sbt_file, OrderedDict())[sample_identifier] = result["tbl2asn"]["manifest"]
+          if len(tbl2asn_batches[sbt_file]) >= args.tbl2asn_batch_size:
+            queueTbl2asnBatch(sbt_file)
+        else:
+          reportProgress(progress, sample_identifier, "completed", getSampleStageTimes(result["profile"]))
+          uploadSamples([sample_identifier])
+
+      #Status, progress and report files are copied along the way so that the job can be followed in the workspace
+      if args.progress_upload_interval > 0 and sample_number % args.progress_upload_interval == 0:
+        uploadProgressFiles()
+
+    current_sample = ""
+    for sbt_file in list(tbl2asn_batches.keys()):
+      queueTbl2asnBatch(sbt_file)
+    for tbl2asn_result in tbl2asn_results:
+      tbl2asn_result.get()
+  except Exception as e:
+    if pool is not None:
+      pool.terminate()
+    if tbl2asn_pool is not None:
+      tbl2asn_pool.terminate()
+    reportProgress(progress, current_sample, "failed", error=str(e))
+    finishProgress(progress, "failed")
+    print("Error processing samples:\n %s" %(e))
+    if uploader is not None:
+      submission_report_file.flush()
+      uploadJobFiles(uploader)
+    sys.exit(-1)
 
-    #Create template file with authour information
-    sbt_file = os.path.join(sample_submission_dir, sample_identifier + ".sbt")
-    createSBTFile(sbt_file, value["row"], job_data)
+  if pool is not None:
+    pool.close()
+    pool.join()
 
-    #Copy template file to manual submission folder
-    sbt_file_ms = os.path.join(manual_sample_submission_dir, sample_identifier + ".sbt")
-    shutil.copy(sbt_file, sbt_file_ms)
+  if tbl2asn_pool is not None:
+    tbl2asn_pool.close()
+    tbl2asn_pool.join()
 
-    #Create sqn file for manual submission
-    try:
-      os.chdir(manual_sample_submission_dir)
-      #tb2asn_cmd = ["tbl2asn", "-p", manual_sample_submission_dir, "-i", fsa_file_ms, "-t", sbt_file_ms, "-o", os.path.join(manual_sample_submission_dir, sample_identifier + ".sqn"), "-V", "bvg", "-a", "d", "-X", "C"] 
-      #Use os.system instead of subprocess until figure out why subporcess is failing
-      os.system("tbl2asn -i " + sample_identifier + ".fsa -t " + sample_identifier + ".sbt -o " + sample_identifier + ".sqn -V bvg -a d -X C")
-      os.remove(sample_identifier + ".gbf")
-      os.remove(sample_identifier + ".t2g")
-      os.remove(sample_identifier + ".val")
-    except Exception as e:
-      print("Error creating sqn file:\n %s" %(e))
+  #Close file
+  submission_report_file.close()
+  if args.report_parquet:
+    stage = startProfileStage()
+    writeReportParquet(submission_report_file_path, os.path.join(output_dir, REPORT_PARQUET_FILE_NAME))
+    endProfileStage(stage, "report_parquet")
+  shutil.rmtree(sbt_dir, ignore_errors=True)
+  shutil.rmtree(tbl2asn_dir, ignore_errors=True)
+
+  if flan_server is not None:
+    stopFluValidatorServer(flan_server)
+
+  if options["annotation_cache"]:
+    evicted = evictAnnotationCache(options["annotation_cache"], args.annotation_cache_size * 1024 * 1024)
+    print("Annotation cache: %d hits, %d misses, %d entries evicted" %(counters["cache_hits"], counters["cache_misses"], evicted))
+
+  #Write timing and resource profile next to the validation report
+  endProfileStage(job_stage, "job")
+  summary = {"samples": len(sample_info),
+             "sequences": sum(len(value["fasta"]) for value in sample_info.values()),
+             "workers": args.workers,
+             "vigor_mode": args.vigor_mode,
+             "tbl2asn_mode": args.tbl2asn_mode,
+             "segment_classifier": args.segment_classifier,
+             "annotations_saved": counters["annotations_saved"],
+             "wall_time": PROFILE_RECORDS[-1]["Wall_Time"],
+             "cpu_time": PROFILE_RECORDS[-1]["CPU_Time"],
+             "peak_rss_mb": PROFILE_RECORDS[-1]["Peak_RSS_MB"]}
+  writeProfile(output_dir, PROFILE_RECORDS, summary)
+  finishProgress(progress, "completed")
+
+  #Upload the remaining top level files once they are final
+  if uploader is not None:
+    uploadJobFiles(uploader)
+
+def runDaemonJob(args, job_file, output_dir, log_file):
+  #Runs in a child forked from the daemon, output of the job and its tools goes to the job log
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.SIG_DFL)
+  with open(log_file, "a") as lf:
+    os.dup2(lf.fileno(), sys.stdout.fileno())
+    os.dup2(lf.fileno(), sys.stderr.fileno())
+  del PROFILE_RECORDS[:]
+  runJob(args, job_file, output_dir)
+
+def stopDaemon(signum, frame):
+  DAEMON_STATE["stopping"] = True
+
+def runDaemon(args):
+  #Serve job files dropped into the spool folder from one warm process. Every job runs in a child forked from it,
+  #so resources, the compiled SBT template and the k-mer index are ready and jobs are isolated from each other.
+  spool_dir = os.path.abspath(args.daemon)
+  output_root = os.path.abspath(args.output)
+  for folder in [spool_dir, output_root] + [os.path.join(spool_dir, name) for name in DAEMON_FOLDER_NAMES]:
+    if not os.path.isdir(folder):
+      os.makedirs(folder)
+
+  if not SBT_TEMPLATE_PARTS:
+    SBT_TEMPLATE_PARTS.extend(compileSBTTemplate(SBT_TEMPLATE))
+  if args.segment_classifier == "kmer":
+    if np is None:
+      print("NumPy is required for the k-mer segment classifier")
       sys.exit(-1)
+    kmer_index = os.path.abspath(args.kmer_index)
+    if not isKmerIndexCurrent(kmer_index):
+      buildKmerIndex(kmer_index)
+    loadKmerIndex(kmer_index)
+  if args.normalize_metadata and hasNormalizationTables():
+    index_dir = os.path.abspath(args.normalization_index)
+    if not isNormalizationIndexCurrent(index_dir):
+      buildNormalizationIndex(index_dir)
+    loadNormalizationIndex(index_dir)
+
+  signal.signal(signal.SIGTERM, stopDaemon)
+  signal.signal(signal.SIGINT, stopDaemon)
+  print("Waiting for jobs in %s" %(spool_dir))
+  sys.stdout.flush()
+
+  running = {}
+  while not DAEMON_STATE["stopping"] or running:
+    #Move job files of finished jobs to done or failed
+    for name, process in list(running.items()):
+      if process.is_alive():
+        continue
+      process.join()
+      status = "done" if process.exitcode == 0 else "failed"
+      os.rename(os.path.join(spool_dir, "running", name), os.path.join(spool_dir, status, name))
+      print("Job %s %s" %(os.path.splitext(name)[0], status))
+      sys.stdout.flush()
+      del running[name]
+
+    #Claim new job files, renaming is atomic so only one daemon claims a job when several share the spool folder
+    for job_file in sorted(glob.glob(os.path.join(spool_dir, "*.json"))):
+      if DAEMON_STATE["stopping"] or len(running) >= args.max_jobs:
+        break
+      name = os.path.basename(job_file)
+      running_file = os.path.join(spool_dir, "running", name)
+      try:
+        os.rename(job_file, running_file)
+      except OSError:
+        continue
+
+      job_name = os.path.splitext(name)[0]
+      print("Starting job %s" %(job_name))
+      sys.stdout.flush()
+      process = multiprocessing.Process(target=runDaemonJob, args=(args, running_file, os.path.join(output_root, job_name), os.path.join(spool_dir, "logs", job_name + ".log")))
+      process.start()
+      running[name] = process
+
+    time.sleep(args.daemon_poll)
+
+  print("Daemon stopped")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Sequence Submission Script")
+  parser.add_argument("-j", "--jfile", help="json file for job, required unless shards are merged or a daemon is started", required=False)
+  parser.add_argument("-o", "--output", help="Output directory, a daemon writes every job into a subfolder named after its job file. defaults to current directory", required=False, default=".")
+  parser.add_argument("-w", "--workers", help="Number of samples processed in parallel. defaults to 1", required=False, type=int, default=1)
+  parser.add_argument("--resume", help="Skip samples completed by a previous run into the same output directory and rebuild the report from their manifests", required=False, action="store_true")
+  parser.add_argument("--data-api", help="Data API URL used to fetch the sequences of id_list and genome_group inputs", required=False, default=None)
+  parser.add_argument("--data-api-batch-size", help="Number of genomes fetched by one data API request. defaults to 100", required=False, type=int, default=100)
+  parser.add_argument("--data-api-workers", help="Number of concurrent data API requests. defaults to 4", required=False, type=int, default=4)
+  parser.add_argument("--validate-only", help="Only validate the FASTA and metadata files without running annotation", required=False, action="store_true")
+  parser.add_argument("--vigor-mode", help="Run VIGOR4 for the sample and for every segment (segment), only once per sample (sample) or once per chunk of sequences across samples (batch). defaults to segment", required=False, choices=["segment", "sample", "batch"], default="segment")
+  parser.add_argument("--vigor-batch-size", help="Maximum number of sequences in a VIGOR4 batch chunk. defaults to 800", required=False, type=int, default=800)
+  parser.add_argument("--segment-classifier", help="Classify segment and subtype of each sequence with reference k-mers (kmer), a fluValidator2 server (flan) or not at all (none). defaults to none", required=False, choices=["none", "kmer", "flan"], default="none")
+  parser.add_argument("--kmer-index", help="Folder of the precomputed k-mer index, built from the Elvira references when missing", required=False, default=os.path.join(tempfile.gettempdir(), "bvbrc_sequence_submission_kmer_index"))
+  parser.add_argument("--normalization-index", help="Folder of the precompiled country and host index, built from the Elvira tables when missing", required=False, default=os.path.join(tempfile.gettempdir(), "bvbrc_sequence_submission_normalization_index"))
+  parser.add_argument("--no-normalize-metadata", help="Do not normalize Collection Country and check Host against the Elvira tables", required=False, dest="normalize_metadata", action="store_false")
+  parser.add_argument("--flan-batch-size", help="Number of segment FASTA files validated by one fluValidator2 run in flan mode. defaults to 64", required=False, type=int, default=64)
+  parser.add_argument("--flan-batch-wait", help="Seconds the flan server waits to fill a batch. defaults to 0.5", required=False, type=float, default=0.5)
+  parser.add_argument("--tbl2asn-mode", help="Run tbl2asn for every sample (sample) or over folders of staged samples with -p (batch). defaults to sample", required=False, choices=["sample", "batch"], default="sample")
+  parser.add_argument("--tbl2asn-batch-size", help="Maximum number of samples staged for one tbl2asn run in batch mode. defaults to 200", required=False, type=int, default=200)
+  parser.add_argument("--zip-compression-level", help="Compression level of submission.zip files from 0 (stored) to 9, levels other than 0 and 6 need Python 3.7 or later. defaults to 6", required=False, type=int, choices=range(10), default=6)
+  parser.add_argument("--report-parquet", help="Also write the validation report as a Parquet file, requires pyarrow", required=False, action="store_true")
+  parser.add_argument("--upload-folder", help="Workspace folder receiving the results, sample folders are uploaded as soon as samples complete", required=False, default=None)
+  parser.add_argument("--upload-workers", help="Number of concurrent workspace uploads. defaults to 4", required=False, type=int, default=4)
+  parser.add_argument("--progress-upload-interval", help="Upload the status, progress and report files every N samples while results are uploaded, 0 only uploads them at the end. defaults to 25", required=False, type=int, default=25)
+  parser.add_argument("--tool-limit", help="Maximum number of concurrent runs of an external tool across workers as TOOL=N, can be repeated. p3-cp defaults to 4", required=False, type=parseToolSetting, action="append", default=[])
+  parser.add_argument("--tool-timeout", help="Timeout of an external tool in seconds as TOOL=SECONDS, can be repeated. 0 disables the timeout", required=False, type=parseToolSetting, action="append", default=[])
+  parser.add_argument("--shard", help="Only process the samples of shard i of N (0 <= i < N) as i/N, samples are assigned by a hash of their identifier", required=False, type=parseShard, default=None)
+  parser.add_argument("--merge-shards", help="Merge the output directories of all shards into the output directory instead of running a job", required=False, nargs="+", default=None)
+  parser.add_argument("--daemon", help="Run as a daemon processing job files moved into this spool folder, files are claimed once they end in .json", required=False, default=None)
+  parser.add_argument("--max-jobs", help="Number of jobs a daemon runs concurrently. defaults to 2", required=False, type=int, default=2)
+  parser.add_argument("--daemon-poll", help="Seconds between scans of the spool folder. defaults to 0.2", required=False, type=float, default=0.2)
+  parser.add_argument("--reference-db-dir", help="Node local folder receiving copies of the VIGOR4 reference databases used by the job", required=False, default=os.path.join(tempfile.gettempdir(), "bvbrc_sequence_submission_reference_dbs"))
+  parser.add_argument("--no-stage-reference-db", help="Run VIGOR4 against the reference databases on shared storage", required=False, dest="stage_reference_db", action="store_false")
+  parser.add_argument("--annotation-cache", help="Folder of the persistent VIGOR4 annotation cache used by sample and batch modes", required=False, default=None)
+  parser.add_argument("--annotation-cache-size", help="Size cap of the annotation cache in MB. defaults to 1024", required=False, type=int, default=1024)
 
-    os.chdir(sample_dir)
+  args = parser.parse_args()
 
-    #Create submission.zip files
-    createZipFile(sample_submission_dir, False)
-    createZipFile(manual_sample_submission_dir, True)
+  if args.merge_shards:
+    mergeShards([os.path.abspath(shard_dir) for shard_dir in args.merge_shards], os.path.abspath(args.output))
+    sys.exit(0)
 
-    #Create submission.xml file
-    submission_file = os.path.join(sample_submission_dir, "submission.xml")
-    submission_date = datetime.today().strftime('%Y-%m-%d')
-    createSubmissionXML(submission_file, sample_identifier, submission_date)
+  if not args.jfile and not args.daemon:
+    parser.error("argument -j/--jfile is required")
 
-    #Copy submission.xml file to manual submission folder
-    shutil.copy(submission_file, os.path.join(manual_sample_submission_dir, "submission.xml"))
+  print("SBT TEMPLATE:\n %s" %(SBT_TEMPLATE))
 
-    #Create submit.ready files
-    with open(os.path.join(sample_submission_dir, "submit.ready"), "w") as sr:
-      pass
-    with open(os.path.join(manual_sample_submission_dir, "submit.ready"), "w") as sr:
-      pass
+  #Tool limits are shared with the FLAN server, the worker processes and the jobs of a daemon
+  tool_limits = dict(TOOL_LIMITS)
+  tool_limits.update(args.tool_limit)
+  tool_semaphores = dict((tool, multiprocessing.BoundedSemaphore(limit)) for tool, limit in tool_limits.items() if limit > 0)
+  initToolScheduler(tool_semaphores, dict(args.tool_timeout))
 
-  #Change working directory back to output folder
-  os.chdir(output_dir)
-  
-  #Close file
-  submission_report_file.close()
+  if args.daemon:
+    runDaemon(args)
+  else:
+    runJob(args, args.jfile, os.path.abspath(args.output))
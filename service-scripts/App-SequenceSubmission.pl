@@ -16,6 +16,28 @@ use IPC::Run qw(run);
 use Cwd;
 use Clone;
 
+#
+# Cost model used to size jobs. tests/benchmark/calibrate_cost_model.py fits
+# seconds_per_sequence, base_runtime and the memory coefficients to the
+# Sequence_Submission_Profile.json files of finished jobs. Refit them when
+# production profiles are available or the pipeline changes. Until then the
+# runtime terms are planning values, and memory matches the flat 16G that the
+# service requested for 2 workers before the cost model. Declared before
+# $script->run so that preflight and process_sequencesubmission see it.
+#
+my %cost_model = (bytes_per_sequence => 1600,      # average influenza segment with its header
+                  sequences_per_genome => 8,       # segments fetched per genome of id_list inputs
+                  seconds_per_sequence => 12,      # VIGOR4, tbl2asn and packaging per sequence on one core
+                  sequences_per_cpu => 200,        # keeps a worker busy for about 40 minutes
+                  base_runtime => 1800,            # fetch, validation and upload
+                  runtime_safety_factor => 2,
+                  base_memory_gb => 2,
+                  memory_per_cpu_gb => 7,          # one VIGOR4 JVM per worker, 2 workers get the former 16G
+                  min_cpu => 1,
+                  max_cpu => 16,
+                  min_runtime => 3600,
+                  max_runtime => 172800);
+
 my $script = Bio::KBase::AppService::AppScript->new(\&process_sequencesubmission, \&preflight);
 
 my $rc = $script->run(\@ARGV);
@@ -28,14 +50,74 @@ sub preflight
 
     print STDERR "preflight sequencesubmission ", Dumper($params, $app);
 
+    my $estimate = estimate_resources($app, $params);
+    print STDERR "preflight estimate ", Dumper($estimate);
+
     return {
-	cpu => 2,
-	memory => "16G",
-	runtime => 36000,
+	cpu => $estimate->{cpu},
+	memory => $estimate->{memory},
+	runtime => $estimate->{runtime},
 	storage => 0,
     };
 }
 
+#
+# Estimate the number of sequences from the job parameters and derive cpu,
+# memory and runtime from the cost model.
+#
+sub estimate_resources
+{
+    my($app, $params) = @_;
+
+    my $sequences = $params->{numberOfSequences};
+    if (!$sequences || $sequences !~ /^\d+$/)
+    {
+	my $bytes = 0;
+	if ($params->{input_source} eq 'fasta_data')
+	{
+	    $bytes = length($params->{input_fasta_data});
+	}
+	elsif ($params->{input_source} eq 'fasta_file' && $app)
+	{
+	    $bytes = eval { $app->workspace->stat($params->{input_fasta_file})->size } || 0;
+	}
+	elsif ($params->{input_source} eq 'id_list')
+	{
+	    my $ids = ref($params->{input_id_list}) ? $params->{input_id_list} : [split(/[\s,]+/, $params->{input_id_list})];
+	    $bytes = @$ids * $cost_model{sequences_per_genome} * $cost_model{bytes_per_sequence};
+	}
+	elsif ($params->{input_source} eq 'genome_group')
+	{
+	    my $genomes = eval {
+		my $group = decode_json($app->workspace->download_file_to_string($params->{input_genome_group}, $app->token()));
+		scalar @{$group->{id_list}->{genome_id}};
+	    };
+
+	    #
+	    # Keep the fixed allocation used before the cost model when the
+	    # group can't be read.
+	    #
+	    return { sequences => undef, cpu => 2, memory => "16G", runtime => 36000 } if !$genomes;
+
+	    $bytes = $genomes * $cost_model{sequences_per_genome} * $cost_model{bytes_per_sequence};
+	}
+	$sequences = int($bytes / $cost_model{bytes_per_sequence}) + 1;
+    }
+
+    my $cpu = int(($sequences + $cost_model{sequences_per_cpu} - 1) / $cost_model{sequences_per_cpu});
+    $cpu = $cost_model{min_cpu} if $cpu < $cost_model{min_cpu};
+    $cpu = $cost_model{max_cpu} if $cpu > $cost_model{max_cpu};
+
+    my $memory = $cost_model{base_memory_gb} + $cost_model{memory_per_cpu_gb} * $cpu;
+
+    my $runtime = $cost_model{base_runtime} +
+	int($cost_model{runtime_safety_factor} * $sequences * $cost_model{seconds_per_sequence} / $cpu);
+    $runtime = $cost_model{min_runtime} if $runtime < $cost_model{min_runtime};
+    $runtime = $cost_model{max_runtime} if $runtime > $cost_model{max_runtime};
+
+    return { sequences => $sequences, cpu => $cpu, memory => "${memory}G", runtime => $runtime };
+}
+
 sub process_sequencesubmission
 {
     my($app, $app_def, $raw_params, $params) = @_;
@@ -78,9 +160,22 @@ sub process_sequencesubmission
     print JDESC JSON::XS->new->pretty(1)->encode($params_to_app);
     close(JDESC);
 
-    my $parallel = $ENV{P3_ALLOCATED_CPU};
+    # Size the workers to the allocation, or to the estimate when run outside the scheduler
+    my $parallel = $ENV{P3_ALLOCATED_CPU} || estimate_resources($app, $params)->{cpu};
 
     my @cmd = ("run_sequence_submission","-o",$work_dir,"--jfile", $jdesc);
+    push(@cmd, "--workers", $parallel) if $parallel;
+
+    # Persistent annotation cache shared between jobs, if configured on the node.
+    # The cache is only used by the batch and sample VIGOR4 modes.
+    my $annotation_cache = $ENV{P3_SEQUENCE_SUBMISSION_CACHE};
+    push(@cmd, "--annotation-cache", $annotation_cache, "--vigor-mode", "batch") if $annotation_cache;
+
+    # Sequences of id_list and genome_group inputs are fetched from the data API
+    push(@cmd, "--data-api", $data_api) if $data_api;
+
+    # Results are uploaded by the driver as samples complete
+    push(@cmd, "--upload-folder", $app->result_folder);
 
     warn Dumper (\@cmd, $params_to_app);
 
@@ -90,33 +185,4 @@ sub process_sequencesubmission
     {
         die "Command failed: @cmd\n";
     }
-
-    my %suffix_map = (csv => 'csv',
-                      fasta => 'contigs',
-                      fsa => 'contigs',
-                      src => 'csv',
-                      xml => 'xml');
-
-    my @suffix_map = map { ("--map-suffix", "$_=$suffix_map{$_}") } keys %suffix_map;
-
-    if (opendir(my $dh, $work_dir))
-    {
-        while (my $p = readdir($dh))
-        {
-            next if $p =~ /^\./;
-
-            my @cmd = ("p3-cp", "-r", "-f", @suffix_map, "$work_dir/$p", "ws:" . $app->result_folder);
-            print "@cmd\n";
-            my $ok = IPC::Run::run(\@cmd);
-            if (!$ok)
-            {
-                warn "Error $? copying output with @cmd\n";
-            }
-        } 
-        closedir($dh);
-    }
-    else
-    {
-        warn "Output directory $work_dir does not exist\n";
-    }
 }
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+#Fits the cost model of service-scripts/App-SequenceSubmission.pl to the Sequence_Submission_Profile.json files
+#of finished jobs. The job wall time is modelled as base_runtime + seconds_per_sequence * sequences / workers,
+#memory as base_memory_gb for the driver plus memory_per_cpu_gb for the VIGOR4 process of every worker.
+
+import argparse
+import json
+import math
+import os
+import sys
+
+PROFILE_FILE_NAME = "Sequence_Submission_Profile.json"
+#Peak memory is rounded up with this headroom so that jobs are not killed at the measured peak
+MEMORY_HEADROOM = 1.5
+
+def readProfile(path):
+  if os.path.isdir(path):
+    path = os.path.join(path, PROFILE_FILE_NAME)
+  with open(path) as pf:
+    profile = json.load(pf)
+
+  vigor4_rss = [stage["peak_rss_mb"] for name, stage in profile["stages"].items() if name.split(":")[-1] == "vigor4"]
+  return {"path": path,
+          "sequences": profile["summary"]["sequences"],
+          "workers": profile["summary"]["workers"],
+          "wall_time": profile["summary"]["wall_time"],
+          "driver_rss_mb": profile["summary"]["peak_rss_mb"],
+          "vigor4_rss_mb": max(vigor4_rss) if vigor4_rss else 0.0}
+
+def fitRuntime(profiles):
+  #Least squares line of the wall time over the sequences per worker
+  xs = [float(profile["sequences"]) / profile["workers"] for profile in profiles]
+  ys = [profile["wall_time"] for profile in profiles]
+  x_mean = sum(xs) / len(xs)
+  y_mean = sum(ys) / len(ys)
+  variance = sum((x - x_mean) ** 2 for x in xs)
+  if variance == 0:
+    print("Profiles need at least two different numbers of sequences per worker")
+    sys.exit(-1)
+
+  slope = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / variance
+  intercept = y_mean - slope * x_mean
+  residuals = [y - (intercept + slope * x) for x, y in zip(xs, ys)]
+  return intercept, slope, max(abs(residual) for residual in residuals)
+
+def roundUpGB(rss_mb):
+  return max(1, int(math.ceil(rss_mb * MEMORY_HEADROOM / 1024.0)))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Fit the job cost model to the profiles of finished jobs")
+  parser.add_argument("profiles", help="Sequence_Submission_Profile.json files or output folders of finished jobs", nargs="+")
+
+  args = parser.parse_args()
+
+  profiles = [readProfile(path) for path in args.profiles]
+  print("%10s %8s %10s %12s %12s  %s" %("sequences", "workers", "wall (s)", "driver MB", "vigor4 MB", "profile"))
+  for profile in profiles:
+    print("%10d %8d %10.1f %12.1f %12.1f  %s" %(profile["sequences"], profile["workers"], profile["wall_time"], profile["driver_rss_mb"], profile["vigor4_rss_mb"], profile["path"]))
+
+  base_runtime, seconds_per_sequence, max_residual = fitRuntime(profiles)
+  print("\nWall time fit over %d profiles, largest residual %.1f seconds\n" %(len(profiles), max_residual))
+  print("seconds_per_sequence => %.3f," %(seconds_per_sequence))
+  print("base_runtime => %d," %(int(math.ceil(max(base_runtime, 0)))))
+  print("base_memory_gb => %d," %(roundUpGB(max(profile["driver_rss_mb"] for profile in profiles))))
+  print("memory_per_cpu_gb => %d," %(roundUpGB(max(profile["vigor4_rss_mb"] for profile in profiles))))
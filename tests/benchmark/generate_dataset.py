@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import json
+import os
+import random
+
+#Segment lengths and names per virus type, within the ranges accepted by the sequence QC
+VIRUS_TYPES = [{"organism": "Influenza A virus", "prefix": "A", "subtype": "H3N2",
+                "segments": [2341, 2341, 2233, 1762, 1565, 1467, 1027, 890]},
+               {"organism": "Influenza B virus", "prefix": "B", "subtype": "",
+                "segments": [2369, 2396, 2308, 1882, 1841, 1557, 1191, 1096]},
+               {"organism": "Influenza C virus", "prefix": "C", "subtype": "",
+                "segments": [2365, 2363, 2183, 2073, 1809, 1180, 934]}]
+METADATA_HEADER = ["Sample Identifier", "Strain Name", "Organism", "Collection Date", "Collection Country", "Host",
+                   "Isolation Source", "Subtype", "Authors", "Publication Title", "Publication PMID",
+                   "BioProject Accession", "BioSample Accession"]
+#Random coding sequences without internal stop codons
+SENSE_CODONS = [a + b + c for a in "ACGT" for b in "ACGT" for c in "ACGT" if a + b + c not in ("TAA", "TAG", "TGA")]
+HOSTS = ["Duck", "Chicken", "Human", "Swine", "Mallard"]
+COUNTRIES = ["USA", "Canada", "Mexico", "Peru", "Germany"]
+
+def generateDataset(output_dir, sequence_count, seed, duplicate_fraction, empty_sequences=0):
+  #Samples cycle through the virus types, the last sample is cut to the requested sequence count
+  rng = random.Random(seed)
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+
+  #Internal segments are shared between samples of the same type to mimic outbreak batches
+  shared_segments = {}
+
+  samples = 0
+  sequences = 0
+  with open(os.path.join(output_dir, "metadata.csv"), "w") as mf, open(os.path.join(output_dir, "input.fasta"), "w") as ff:
+    writer = csv.DictWriter(mf, fieldnames=METADATA_HEADER)
+    writer.writeheader()
+    while sequences < sequence_count:
+      virus = VIRUS_TYPES[samples % len(VIRUS_TYPES)]
+      sample_identifier = "BENCH%06d" %(samples)
+      host = rng.choice(HOSTS)
+      strain = "%s/%s/%s/%d/2020" %(virus["prefix"], host.lower(), rng.choice(COUNTRIES), samples)
+      if virus["subtype"]:
+        strain += "(%s)" %(virus["subtype"])
+      writer.writerow({"Sample Identifier": sample_identifier,
+                       "Strain Name": strain,
+                       "Organism": virus["organism"],
+                       "Collection Date": "%02d-Mar-2020" %(rng.randint(1, 28)),
+                       "Collection Country": rng.choice(COUNTRIES),
+                       "Host": host,
+                       "Isolation Source": "cloaca" if host != "Human" else "nasal swab",
+                       "Subtype": virus["subtype"],
+                       "Authors": "John A Smith, Jane Doe",
+                       "BioProject Accession": "PRJNA000001"})
+
+      for segment, length in enumerate(virus["segments"], 1):
+        if sequences == sequence_count:
+          break
+        key = (virus["prefix"], segment)
+        if key in shared_segments and rng.random() < duplicate_fraction:
+          sequence = shared_segments[key]
+        else:
+          sequence = "".join(rng.choice(SENSE_CODONS) for i in range(length // 3 + 1))[:length]
+          shared_segments.setdefault(key, sequence)
+
+        ff.write(">Unique_Sample_Identifier:%s|Unique_Sequence_Identifier:%s-%d\n" %(sample_identifier, sample_identifier, segment))
+        #The last records are written as a header followed by a blank line to exercise the input validation
+        if sequences >= sequence_count - empty_sequences:
+          ff.write("\n")
+        else:
+          for start in range(0, len(sequence), 70):
+            ff.write(sequence[start:start + 70] + "\n")
+        sequences += 1
+      samples += 1
+
+  #Workspace paths are resolved against the dataset folder by the p3-cp stub
+  job = {"country": "USA",
+         "numberOfSequences": sequence_count,
+         "output_file": "benchmark",
+         "output_path": "/benchmark",
+         "first_name": "Jane",
+         "last_name": "Doe",
+         "email": "jane.doe@example.org",
+         "affiliation": "Benchmark",
+         "consortium": "",
+         "input_source": "fasta_file",
+         "input_fasta_file": "/input.fasta",
+         "metadata": "/metadata.csv"}
+  with open(os.path.join(output_dir, "job.json"), "w") as jf:
+    json.dump(job, jf, indent=2)
+
+  return {"samples": samples, "sequences": sequences}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Generate a synthetic influenza submission for benchmarks")
+  parser.add_argument("-o", "--output", help="Output directory", required=True)
+  parser.add_argument("-n", "--sequences", help="Number of sequences. defaults to 1000", required=False, type=int, default=1000)
+  parser.add_argument("--seed", help="Random seed. defaults to 1", required=False, type=int, default=1)
+  parser.add_argument("--duplicate-fraction", help="Fraction of segments copied from an earlier sample of the same type. defaults to 0.3", required=False, type=float, default=0.3)
+  parser.add_argument("--empty-sequences", help="Number of records at the end of the input without a sequence. defaults to 0", required=False, type=int, default=0)
+
+  args = parser.parse_args()
+  dataset = generateDataset(args.output, args.sequences, args.seed, args.duplicate_fraction, args.empty_sequences)
+  print("Generated %d samples with %d sequences in %s" %(dataset["samples"], dataset["sequences"], args.output))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+#Local stand-in for the genome_sequence collection of the data API. Serves the sequences of a FASTA file
+#in the Unique_Sample_Identifier:<sample>|Unique_Sequence_Identifier:<sample>-<segment> format with the
+#sample as genome_id, answering in(genome_id,(...)) RQL queries. Random server errors exercise the retries.
+
+import argparse
+import json
+import random
+import re
+import time
+from collections import OrderedDict
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urllib import unquote
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import unquote
+
+GENOME_ID_PATTERN = re.compile(r"in\(genome_id,\(([^)]*)\)\)")
+
+def readGenomeSequences(fasta_file):
+  genomes = OrderedDict()
+  with open(fasta_file) as ff:
+    record = None
+    for line in ff:
+      if line.startswith(">"):
+        ids = line[1:].strip().split("|")
+        genome_id = ids[0].replace("Unique_Sample_Identifier:", "").strip()
+        sequence_id = ids[1].replace("Unique_Sequence_Identifier:", "").strip()
+        record = {"genome_id": genome_id, "accession": sequence_id, "segment": sequence_id.rsplit("-", 1)[-1], "sequence": ""}
+        genomes.setdefault(genome_id, []).append(record)
+      elif record is not None:
+        record["sequence"] += line.strip()
+  return genomes
+
+class DataAPIHandler(BaseHTTPRequestHandler):
+  #Keep-alive connections so that the pooled connections of the driver are reused
+  protocol_version = "HTTP/1.1"
+
+  def do_POST(self):
+    query = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+    time.sleep(self.server.latency)
+    self.server.requests += 1
+
+    if self.path.rstrip("/") != "/genome_sequence":
+      return self.sendResponse(404, {"error": "unknown collection"})
+    if random.random() < self.server.failure_rate:
+      return self.sendResponse(503, {"error": "injected failure"})
+
+    match = GENOME_ID_PATTERN.search(query)
+    if not match:
+      return self.sendResponse(400, {"error": "expected in(genome_id,(...))"})
+    records = []
+    for genome_id in match.group(1).split(","):
+      records.extend(self.server.genomes.get(unquote(genome_id), []))
+    self.sendResponse(200, records)
+
+  def sendResponse(self, status, body):
+    content = json.dumps(body).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args):
+    pass
+
+class DataAPIServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Mock data API serving genome sequences of a FASTA file")
+  parser.add_argument("--fasta", help="FASTA file with the sequences to serve", required=True)
+  parser.add_argument("--port", help="Port to listen on. defaults to 8800", required=False, type=int, default=8800)
+  parser.add_argument("--latency", help="Seconds per request. defaults to 0", required=False, type=float, default=0)
+  parser.add_argument("--failure-rate", help="Fraction of requests answered with HTTP 503. defaults to 0", required=False, type=float, default=0)
+
+  args = parser.parse_args()
+
+  server = DataAPIServer(("127.0.0.1", args.port), DataAPIHandler)
+  server.genomes = readGenomeSequences(args.fasta)
+  server.latency = args.latency
+  server.failure_rate = args.failure_rate
+  server.requests = 0
+  print("Serving %d genomes on http://127.0.0.1:%d" %(len(server.genomes), args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_dataset import generateDataset
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+DRIVER = os.path.join(REPOSITORY_DIR, "scripts", "run_sequence_submission.py")
+STUBS_DIR = os.path.join(BENCHMARK_DIR, "stubs")
+PROFILE_FILE_NAME = "Sequence_Submission_Profile.json"
+
+def runBenchmark(size, work_dir, args):
+  #Generate the dataset in the stub workspace and run the driver against the stub tools
+  workspace = os.path.join(work_dir, "workspace_%d" %(size))
+  output_dir = os.path.join(work_dir, "output_%d" %(size))
+  dataset = generateDataset(workspace, size, args.seed, args.duplicate_fraction)
+
+  env = dict(os.environ)
+  env["PATH"] = STUBS_DIR + os.pathsep + env.get("PATH", "")
+  env["KB_TOP"] = REPOSITORY_DIR
+  env["BENCHMARK_WORKSPACE"] = workspace
+  env["BENCHMARK_P3CP_LATENCY"] = str(args.p3cp_latency)
+  env["BENCHMARK_VIGOR4_LATENCY"] = str(args.vigor_latency)
+  env["BENCHMARK_VIGOR4_SEQUENCE_LATENCY"] = str(args.vigor_sequence_latency)
+  env["BENCHMARK_TBL2ASN_LATENCY"] = str(args.tbl2asn_latency)
+
+  cmd = [args.python, DRIVER, "-j", os.path.join(workspace, "job.json"), "-o", output_dir,
+         "--workers", str(args.workers), "--vigor-mode", args.vigor_mode] + args.driver_args
+  with open(os.path.join(work_dir, "driver_%d.log" %(size)), "w") as log:
+    start_time = time.time()
+    process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    #wait4 reports the peak RSS of the driver and its waited children
+    pid, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.time() - start_time
+
+  if status != 0:
+    print("Driver failed for %d sequences, see %s" %(size, log.name))
+    sys.exit(-1)
+
+  with open(os.path.join(output_dir, PROFILE_FILE_NAME)) as pf:
+    profile = json.load(pf)
+
+  return {"sequences": dataset["sequences"],
+          "samples": dataset["samples"],
+          "wall_time": round(wall_time, 3),
+          "throughput": round(dataset["sequences"] / wall_time, 2),
+          "peak_rss_mb": round(usage.ru_maxrss / 1024.0, 1),
+          "stages": dict((name, stage["wall_time"]) for name, stage in profile["stages"].items())}
+
+def printResults(results):
+  print("%10s %8s %10s %12s %12s" %("sequences", "samples", "wall (s)", "seq/s", "peak RSS MB"))
+  for result in results:
+    print("%10d %8d %10.2f %12.2f %12.1f" %(result["sequences"], result["samples"], result["wall_time"], result["throughput"], result["peak_rss_mb"]))
+
+  for result in results:
+    print("\nStage wall time for %d sequences (summed over samples and tools)" %(result["sequences"]))
+    for name, wall_time in sorted(result["stages"].items(), key=lambda item: -item[1]):
+      print("  %-28s %10.2f" %(name, wall_time))
+
+def compareResults(results, baseline_file, tolerance):
+  #Report sizes whose throughput dropped by more than the tolerance
+  with open(baseline_file) as bf:
+    baseline = dict((result["sequences"], result) for result in json.load(bf)["results"])
+
+  regressions = 0
+  for result in results:
+    previous = baseline.get(result["sequences"])
+    if previous is None:
+      continue
+    change = result["throughput"] / previous["throughput"] - 1
+    print("%d sequences: %.2f seq/s against %.2f seq/s (%+.1f%%)" %(result["sequences"], result["throughput"], previous["throughput"], change * 100))
+    if change < -tolerance:
+      regressions += 1
+
+  return regressions
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark run_sequence_submission.py with synthetic datasets and stub tools")
+  parser.add_argument("--sizes", help="Comma separated dataset sizes in sequences. defaults to 10,1000", required=False, default="10,1000")
+  parser.add_argument("--python", help="Interpreter running the driver. defaults to the current one", required=False, default=sys.executable)
+  parser.add_argument("-w", "--workers", help="Number of driver workers. defaults to 1", required=False, type=int, default=1)
+  parser.add_argument("--vigor-mode", help="VIGOR4 mode of the driver. defaults to sample", required=False, default="sample")
+  parser.add_argument("--p3cp-latency", help="Seconds per p3-cp call. defaults to 0", required=False, type=float, default=0)
+  parser.add_argument("--vigor-latency", help="Seconds per vigor4 call. defaults to 0", required=False, type=float, default=0)
+  parser.add_argument("--vigor-sequence-latency", help="Seconds per sequence annotated by vigor4. defaults to 0", required=False, type=float, default=0)
+  parser.add_argument("--tbl2asn-latency", help="Seconds per tbl2asn call. defaults to 0", required=False, type=float, default=0)
+  parser.add_argument("--seed", help="Random seed of the datasets. defaults to 1", required=False, type=int, default=1)
+  parser.add_argument("--duplicate-fraction", help="Fraction of duplicated segments in the datasets. defaults to 0.3", required=False, type=float, default=0.3)
+  parser.add_argument("--results", help="Write the results to this JSON file", required=False, default=None)
+  parser.add_argument("--baseline", help="Compare throughput with the results of a previous run", required=False, default=None)
+  parser.add_argument("--tolerance", help="Allowed throughput drop against the baseline. defaults to 0.2", required=False, type=float, default=0.2)
+  parser.add_argument("--keep", help="Keep the datasets and outputs in this folder instead of a temporary one", required=False, default=None)
+  parser.add_argument("driver_args", help="Additional driver arguments after --", nargs=argparse.REMAINDER)
+
+  args = parser.parse_args()
+  args.driver_args = [arg for arg in args.driver_args if arg != "--"]
+
+  work_dir = os.path.abspath(args.keep) if args.keep else tempfile.mkdtemp(prefix="sequence_submission_benchmark_")
+  if not os.path.exists(work_dir):
+    os.makedirs(work_dir)
+
+  try:
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+      print("Running benchmark with %d sequences" %(size))
+      results.append(runBenchmark(size, work_dir, args))
+  finally:
+    if not args.keep:
+      shutil.rmtree(work_dir)
+
+  printResults(results)
+
+  if args.results:
+    with open(args.results, "w") as rf:
+      json.dump({"arguments": dict((key, value) for key, value in vars(args).items() if key not in ("results", "baseline", "keep")),
+                 "results": results}, rf, indent=2)
+
+  if args.baseline:
+    regressions = compareResults(results, args.baseline, args.tolerance)
+    if regressions:
+      print("Throughput regressed for %d dataset sizes" %(regressions))
+      sys.exit(1)